@@ -15,8 +15,15 @@
     ],
     "data": [
         "data/delivery_carrier_label_postnl_data.xml",
+        "security/ir.model.access.csv",
         "data/ir_config_parameter.xml",
+        "data/ir_cron.xml",
+        "wizard/postnl_rate_import_views.xml",
         "views/delivery_carrier_views.xml",
+        "views/postnl_shipment_job_views.xml",
+        "views/postnl_ship_wave_views.xml",
+        "views/postnl_api_call_views.xml",
+        "views/stock_picking_views.xml",
     ],
     "installable": True,
 }
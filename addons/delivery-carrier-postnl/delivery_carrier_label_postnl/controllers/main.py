@@ -0,0 +1,52 @@
+import hmac
+import tempfile
+
+from odoo import http
+from odoo.http import request
+
+
+class PostNLMetricsController(http.Controller):
+
+    @http.route("/postnl/metrics", type="http", auth="public", methods=["GET"], csrf=False)
+    def metrics(self, token=None, hours=24, **kwargs):
+        """ Exposes the PostNL API metrics in the Prometheus text format. The scraper has to
+        pass the `postnl_metrics_token` system parameter as `token`. """
+        expected_token = request.env["ir.config_parameter"].sudo().get_param("postnl_metrics_token")
+        if not expected_token or not token or not hmac.compare_digest(expected_token, token):
+            return request.not_found()
+
+        lines = []
+        for metrics in request.env["postnl.api.call"].sudo().get_postnl_metrics(hours=int(hours)):
+            labels = 'carrier="{}"'.format(metrics["carrier_name"].replace('"', "'"))
+            lines += [
+                "postnl_api_calls_total{{{}}} {}".format(labels, metrics["call_count"]),
+                "postnl_api_errors_total{{{}}} {}".format(labels, metrics["error_count"]),
+                "postnl_api_error_rate{{{}}} {}".format(labels, metrics["error_rate"]),
+                "postnl_api_retries_total{{{}}} {}".format(labels, metrics["retry_count"]),
+                "postnl_api_pickings_total{{{}}} {}".format(labels, metrics["picking_count"]),
+            ]
+            for quantile in ("p50", "p95", "p99"):
+                lines.append('postnl_api_call_ms{{{},quantile="0.{}"}} {}'.format(
+                    labels, quantile[1:], metrics[quantile]))
+        return request.make_response(
+            "\n".join(lines) + "\n", headers=[("Content-Type", "text/plain; version=0.0.4")])
+
+
+class PostNLLabelController(http.Controller):
+
+    @http.route("/postnl/labels/<int:print_id>", type="http", auth="user", methods=["GET"])
+    def labels(self, print_id, **kwargs):
+        """ Streams the merged labels of a `postnl.label.print` from a temporary file,
+        which is closed once the response is sent. """
+        label_print = request.env["postnl.label.print"].browse(print_id).exists()
+        if not label_print:
+            return request.not_found()
+        merged_file = tempfile.TemporaryFile()
+        try:
+            filename, mimetype = label_print.picking_ids._write_postnl_labels(merged_file)
+            merged_file.seek(0)
+            return http.send_file(
+                merged_file, filename=filename, mimetype=mimetype, as_attachment=True, cache_timeout=0)
+        except Exception:
+            merged_file.close()
+            raise
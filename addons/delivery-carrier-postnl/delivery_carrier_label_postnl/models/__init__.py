@@ -1,2 +1,11 @@
 from . import delivery_carrier
+from . import postnl_api_call
+from . import postnl_barcode
+from . import postnl_rate
+from . import postnl_rate_limit
+from . import product_template
+from . import shipping_label
 from . import stock_picking
+from . import postnl_shipment_job
+from . import postnl_shipment_log
+from . import postnl_ship_wave
@@ -1,7 +1,15 @@
 import base64
-from odoo import models, fields, _
+from bisect import bisect_left
+from odoo import api, models, fields, tools, _
 from odoo.exceptions import UserError
-from .postnl_api import PostNLAPI
+from .postnl_api import PostNLAPI, POSTNL_MESSAGE_PRINTER_TYPE, POSTNL_PRINTER_TYPES
+
+# upper weight bound in kg of each PostNL package product
+POSTNL_PAKKET_BANDS = [
+    (2, "delivery_carrier_label_postnl.product_product_delivery_postnl_pakket_2"),
+    (10, "delivery_carrier_label_postnl.product_product_delivery_postnl_pakket_10"),
+    (float("inf"), "delivery_carrier_label_postnl.product_product_delivery_postnl_pakket_23"),
+]
 
 
 class DeliveryCarrier(models.Model):
@@ -12,11 +20,37 @@ class DeliveryCarrier(models.Model):
     postnl_customer_code = fields.Char(string="PostNL Customer Code")
     postnl_customer_number = fields.Char(string="PostNL Customer Number")
     postnl_confirm_shipment = fields.Boolean(string="Confirm Shipment When Sending (PostNL)", default=True)
+    postnl_deferred_shipping = fields.Boolean(
+        string="Send Shipments Asynchronously (PostNL)",
+        help="Validating a transfer queues its shipment, which is then sent to PostNL by a scheduled action.")
+    postnl_product_code = fields.Char(
+        string="PostNL Product Code", default="3085",
+        help="PostNL product code of the shipments, also used to look up the rates.")
+    postnl_printer_type = fields.Selection(
+        POSTNL_PRINTER_TYPES, string="PostNL Label Format", default=POSTNL_MESSAGE_PRINTER_TYPE,
+        help="PDF labels, or ZPL print jobs for thermal printers.")
+    postnl_use_barcode_pool = fields.Boolean(
+        string="Use a Barcode Pool (PostNL)",
+        help="Barcodes are fetched from PostNL in bulk ahead of time and handed out to the transfers, "
+             "instead of being generated by the shipment call.")
+    postnl_barcode_type = fields.Char(string="PostNL Barcode Type", default="3S")
+    postnl_barcode_serie = fields.Char(string="PostNL Barcode Serie", default="000000000-999999999")
+    postnl_barcode_pool_size = fields.Integer(string="PostNL Barcode Pool Size", default=100)
+    postnl_rate_ids = fields.One2many("postnl.rate", "carrier_id", string="PostNL Rates")
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        # the PostNL clients are cached from these fields
+        if any(field_name.startswith("postnl_") or field_name == "prod_environment" for field_name in vals):
+            self.clear_caches()
+        return res
 
     def postnl_rate_shipment(self, order):
         """ Compute the price of the order shipment with PostNL.
         PostNL does not offer an API to retrieve rates, but we can maintain the current
-        package costs by weight retrieved from the products defined in the module data.
+        package costs by weight in the rate table of the carrier, or retrieve them from
+        the products defined in the module data when the carrier has no rates.
 
         :param order: record of sale.order
         :return dict: {'success': boolean,
@@ -25,42 +59,159 @@ class DeliveryCarrier(models.Model):
                        'warning_message': a string containing a warning message}
         """
         self.ensure_one()
-        weight = sum([(line.product_id.weight * line.product_qty) for line in order.order_line]) or 0.0
-        price = self._get_postnl_pakket_rate(weight)
+        return self.postnl_rate_shipments(order)[order.id]
 
-        # convert from EUR if another currency
+    def postnl_rate_shipments(self, orders):
+        """ Compute the price of the shipment of many orders at once with PostNL,
+        e.g. to reprice open quotations after a tariff change. The weights are summed
+        in a single query and the currency rates are read once per currency, company and date.
+
+        :param orders: recordset of sale.order
+        :return dict: {order id: the result of `postnl_rate_shipment`}
+        """
+        self.ensure_one()
+        weights = self._get_postnl_order_weights(orders)
         eur_currency = self.env.ref("base.EUR", raise_if_not_found=False)
-        if order.currency_id != eur_currency:
-            price = eur_currency._convert(price, order.currency_id, order.company_id, order.date_order or fields.Date.today())
+        conversion_rates = {}
+        result = {}
+        for order in orders:
+            weight = weights.get(order.id, 0.0)
+            country_code = order.partner_shipping_id.country_id.code
+            price = self._get_postnl_price(weight, country_code)
+            if price is None:
+                result[order.id] = {
+                    'success': False,
+                    'price': 0.0,
+                    'error_message': _("No PostNL rate found for %s kg to %s.") % (
+                        self._convert_weight_to_kg(weight), country_code or _("this destination")),
+                    'warning_message': False,
+                }
+                continue
 
-        return {
-            'success': True,
-            'price': price,
-            'error_message': False,
-            'warning_message': "Please make sure to have the latest PostNL product prices, as the PostNL API does not retrieve them."
-        }
+            # convert from EUR if another currency
+            if order.currency_id != eur_currency:
+                date = fields.Date.to_date(order.date_order) or fields.Date.today()
+                key = (order.currency_id, order.company_id, date)
+                if key not in conversion_rates:
+                    conversion_rates[key] = self.env["res.currency"]._get_conversion_rate(
+                        eur_currency, order.currency_id, order.company_id, date)
+                price = order.currency_id.round(price * conversion_rates[key])
 
-    def postnl_send_shipping(self, pickings):
+            result[order.id] = {
+                'success': True,
+                'price': price,
+                'error_message': False,
+                'warning_message': "Please make sure to have the latest PostNL product prices, as the PostNL API does not retrieve them."
+            }
+        return result
+
+    @api.model
+    def _get_postnl_order_weights(self, orders):
+        """ Returns {order id: weight of the order lines in the weight UoM}, summed with
+        a single query over the saved orders. """
+        weights = {}
+        new_orders = orders.filtered(lambda order: isinstance(order.id, models.NewId))
+        for order in new_orders:
+            weights[order.id] = sum([(line.product_id.weight * line.product_qty) for line in order.order_line]) or 0.0
+        saved_orders = orders - new_orders
+        if saved_orders:
+            self.env.cr.execute("""
+                SELECT line.order_id,
+                       SUM(product.weight * line.product_uom_qty / line_uom.factor * product_uom.factor)
+                FROM sale_order_line line
+                JOIN product_product product ON product.id = line.product_id
+                JOIN product_template template ON template.id = product.product_tmpl_id
+                JOIN uom_uom line_uom ON line_uom.id = line.product_uom
+                JOIN uom_uom product_uom ON product_uom.id = template.uom_id
+                WHERE line.order_id IN %s
+                GROUP BY line.order_id
+            """, (tuple(saved_orders.ids),))
+            weights.update((order_id, weight or 0.0) for order_id, weight in self.env.cr.fetchall())
+        return weights
+
+    def postnl_send_shipping(self, pickings, raise_on_error=True):
         """ Send the package to PostNL.
 
         :param pickings: A recordset of pickings
+        :param raise_on_error: raise when a picking cannot be shipped; otherwise the
+                               valid pickings are shipped and the others report an error
         :return list: A list of dictionaries (one per picking) containing of the form::
                          { 'exact_price': price,
-                           'tracking_number': number }
+                           'tracking_number': number,
+                           'label_attachment_ids': ids of the label attachments,
+                           'error': False or the reason the picking was not shipped }
         """
         self.ensure_one()
+        if self.postnl_deferred_shipping and not self.env.context.get("postnl_process_jobs"):
+            self.env["postnl.shipment.job"].sudo()._enqueue(self, pickings)
+            return [
+                {"exact_price": 0, "tracking_number": False, "label_attachment_ids": [], "error": False}
+                for picking in pickings
+            ]
+        packages = pickings._get_postnl_packages()
+        for picking in pickings.filtered(lambda picking: not packages[picking.id]):
+            picking._set_a_default_package()
+        if self.postnl_use_barcode_pool:
+            self.env["postnl.barcode"]._reserve(self, pickings)
+        else:
+            # the colli of a multi-collo shipment are grouped under barcodes known beforehand
+            self.env["postnl.barcode"]._reserve(
+                self, pickings.filtered(lambda picking: len(packages[picking.id]) > 1))
+        stats = []
+        try:
+            return self._get_postnl_api().send_postnl_package(pickings, stats=stats, raise_on_error=raise_on_error)
+        finally:
+            self.env["postnl.api.call"]._log_calls(self, stats)
+
+    def _get_postnl_api(self):
+        """ Returns the PostNL client of the carrier, shared by the calls of the process
+        until the carrier or a system parameter changes. """
+        self.ensure_one()
+        return self._get_postnl_api_client(self.id, self.prod_environment)
 
+    @tools.ormcache("carrier_id", "prod_environment")
+    def _get_postnl_api_client(self, carrier_id, prod_environment):
+        """ Instantiates the PostNL client from the carrier and the
+        `postnl_shipping_api_*` system parameters. """
+        carrier = self.browse(carrier_id).sudo()
         ParamObj = self.env["ir.config_parameter"].sudo()
-        if self.prod_environment:
+        if prod_environment:
             shipping_api_url = ParamObj.get_param("postnl_shipping_api_prod_url", default="https://api.postnl.nl/v1/shipment")
+            status_api_url = ParamObj.get_param(
+                "postnl_status_api_prod_url", default="https://api.postnl.nl/shipment/v2/status/barcode")
+            barcode_api_url = ParamObj.get_param(
+                "postnl_barcode_api_prod_url", default="https://api.postnl.nl/shipment/v1_1/barcode")
         else:
             shipping_api_url = ParamObj.get_param("postnl_shipping_api_test_url", default="https://api-sandbox.postnl.nl/v1/shipment")
+            status_api_url = ParamObj.get_param(
+                "postnl_status_api_test_url", default="https://api-sandbox.postnl.nl/shipment/v2/status/barcode")
+            barcode_api_url = ParamObj.get_param(
+                "postnl_barcode_api_test_url", default="https://api-sandbox.postnl.nl/shipment/v1_1/barcode")
 
-        apikey = self.postnl_api_key
+        apikey = carrier.postnl_api_key
         if not apikey:
             raise UserError(_("PostNL API key is not configured!"))
-        postnl = PostNLAPI(shipping_api_url, apikey, self.postnl_confirm_shipment)
-        return postnl.send_postnl_package(pickings)
+        return PostNLAPI(
+            shipping_api_url, apikey, carrier.postnl_confirm_shipment,
+            max_workers=int(ParamObj.get_param("postnl_shipping_api_max_workers", default=1)),
+            batch_size=int(ParamObj.get_param("postnl_shipping_api_batch_size", default=1)),
+            pool_size=int(ParamObj.get_param("postnl_shipping_api_pool_size", default=10)),
+            timeout=(
+                float(ParamObj.get_param("postnl_shipping_api_connect_timeout", default=10)),
+                float(ParamObj.get_param("postnl_shipping_api_read_timeout", default=60)),
+            ),
+            max_retries=int(ParamObj.get_param("postnl_shipping_api_max_retries", default=3)),
+            backoff_factor=float(ParamObj.get_param("postnl_shipping_api_backoff_factor", default=0.5)),
+            status_api_url=status_api_url,
+            barcode_api_url=barcode_api_url,
+            throttle=self.env["postnl.rate.limit"]._get_throttle(apikey),
+        )
+
+    @api.model
+    def _cron_refill_postnl_barcode_pools(self):
+        for carrier in self.search([("delivery_type", "=", "postnl"), ("postnl_use_barcode_pool", "=", True)]):
+            self.env["postnl.barcode"]._refill(carrier)
+            self.env.cr.commit()
 
     def postnl_get_tracking_link(self, picking):
         """ Ask the tracking link to PostNL.
@@ -70,8 +221,7 @@ class DeliveryCarrier(models.Model):
         """
         self.ensure_one()
         res = ''
-        param_obj = self.env["ir.config_parameter"].sudo()
-        base_url = param_obj.get_param("postnl_tracking_base_url", default=False)
+        base_url = self._get_postnl_tracking_base_url()
         if base_url:
             zip_code = picking.partner_id.zip
             carrier_tracking_ref = picking.carrier_tracking_ref
@@ -79,6 +229,10 @@ class DeliveryCarrier(models.Model):
                 res = "{}/{}-NL-{}".format(base_url, carrier_tracking_ref, zip_code)
         return res
 
+    @tools.ormcache()
+    def _get_postnl_tracking_base_url(self):
+        return self.env["ir.config_parameter"].sudo().get_param("postnl_tracking_base_url", default=False)
+
     def postnl_cancel_shipment(self, pickings):
         """ Cancel a PostNL shipment, which is not supported via an API.
 
@@ -88,8 +242,63 @@ class DeliveryCarrier(models.Model):
 
     def _convert_weight_to_kg(self, weight):
         """ Converts weight into kilograms. """
+        return weight * self._get_postnl_weight_uom_factor()
+
+    @api.model
+    @tools.ormcache()
+    def _get_postnl_weight_uom_factor(self):
+        """ Returns the factor converting the configured weight UoM into kilograms,
+        cached per registry. Writing a system parameter clears the cache. """
         weight_uom_id = self.env["product.template"]._get_weight_uom_id_from_ir_config_parameter()
-        return weight_uom_id._compute_quantity(weight, self.env.ref("uom.product_uom_kgm"), round=False)
+        return weight_uom_id._compute_quantity(1.0, self.env.ref("uom.product_uom_kgm"), round=False)
+
+    @api.model
+    @tools.ormcache()
+    def _get_postnl_pakket_bands(self):
+        """ Returns the (upper weight in kg, price) bands of the predefined service products,
+        cached per registry. Writing the price of those products clears the cache. """
+        bands = []
+        for max_weight, xml_id in POSTNL_PAKKET_BANDS:
+            package_product = self.env.ref(xml_id, raise_if_not_found=False)
+            bands.append((max_weight, package_product and package_product.list_price or 0.0))
+        return tuple(bands)
+
+    def _get_postnl_price(self, weight, country_code):
+        """ Returns the price in EUR of a shipment of the given weight (in the weight UoM)
+        to the given country, or None if the rate table of the carrier does not cover it.
+        Falls back on the package products when the carrier has no rate table. """
+        self.ensure_one()
+        rate_table = self._get_postnl_rate_table(self.id)
+        if not rate_table:
+            return self._get_postnl_pakket_rate(weight)
+
+        weight = self._convert_weight_to_kg(weight)
+        product_code = self.postnl_product_code or "3085"
+        for zone in (country_code or "", ""):
+            weight_bands = rate_table.get((product_code, zone))
+            if weight_bands:
+                max_weights, prices = weight_bands
+                index = bisect_left(max_weights, weight)
+                if index < len(prices):
+                    return prices[index]
+        return None
+
+    @api.model
+    @tools.ormcache("carrier_id")
+    def _get_postnl_rate_table(self, carrier_id):
+        """ Returns the rates of the carrier as {(product code, zone): (upper weights, prices)},
+        with the weights sorted for a bisect lookup. Cached per registry, cleared when
+        a rate is written. """
+        rate_table = {}
+        rates = self.env["postnl.rate"].sudo().search_read(
+            [("carrier_id", "=", carrier_id)],
+            ["product_code", "zone", "max_weight", "price"],
+            order="max_weight")
+        for rate in rates:
+            max_weights, prices = rate_table.setdefault((rate["product_code"], rate["zone"] or ""), ([], []))
+            max_weights.append(rate["max_weight"])
+            prices.append(rate["price"])
+        return {key: (tuple(max_weights), tuple(prices)) for key, (max_weights, prices) in rate_table.items()}
 
     def _get_postnl_pakket_rate(self, weight):
         """ Gets the package prices from the predefined service products,
@@ -101,11 +310,7 @@ class DeliveryCarrier(models.Model):
 
         """
         weight = self._convert_weight_to_kg(weight)
-        if weight <= 2:
-            xml_id = "delivery_carrier_label_postnl.product_product_delivery_postnl_pakket_2"
-        elif weight <= 10:
-            xml_id = "delivery_carrier_label_postnl.product_product_delivery_postnl_pakket_10"
-        else:
-            xml_id = "delivery_carrier_label_postnl.product_product_delivery_postnl_pakket_23"
-        package_product = self.env.ref(xml_id, raise_if_not_found=False)
-        return package_product and package_product.list_price or 0.0
+        for max_weight, price in self._get_postnl_pakket_bands():
+            if weight <= max_weight:
+                return price
+        return 0.0
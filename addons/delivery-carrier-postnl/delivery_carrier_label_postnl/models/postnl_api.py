@@ -1,153 +1,627 @@
+import hashlib
 import json
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import urlencode
 from requests import Response
+from urllib3.util.retry import Retry
 
 from odoo import fields, _
 from odoo.exceptions import UserError
 
 POSTNL_MESSAGE_PRINTER_TYPE = "GraphicFile|PDF"
+POSTNL_PRINTER_TYPES = [
+    ("GraphicFile|PDF", "PDF"),
+    ("Zebra|Generic ZPL II 200 dpi", "ZPL II 200 dpi"),
+    ("Zebra|Generic ZPL II 300 dpi", "ZPL II 300 dpi"),
+    ("Zebra|Generic ZPL II 600 dpi", "ZPL II 600 dpi"),
+]
 POSTNL_CUSTOMER_ADDRESS_TYPE = "02"
 POSTNL_SHIPMENTS_ADDRESS_TYPE = "01"
 POSTNL_CONTACT_ADDRESS_TYPE = "01"
+POSTNL_PICKING_FIELDS = ["name", "partner_id", "company_id", "carrier_id", "shipping_weight", "postnl_barcode_id"]
+POSTNL_PARTNER_FIELDS = [
+    "name", "street", "street_number", "street_number2", "city", "zip", "country_id", "email", "mobile", "phone",
+]
+POSTNL_COMPANY_FIELDS = ["name", "street", "city", "zip", "country_id", "email"]
+POSTNL_CARRIER_FIELDS = ["postnl_customer_code", "postnl_customer_number", "postnl_product_code", "postnl_printer_type"]
+POSTNL_RETRY_STATUSES = (429, 500, 502, 503, 504)
+POSTNL_STATUS_DELIVERED = "11"
+
+# process-wide keep-alive sessions, keyed by API URL, key and pool settings
+_sessions = {}
+_sessions_lock = Lock()
+
+
+def _get_retry(max_retries, backoff_factor):
+    """ Retries connection errors and 429/5xx responses with exponential backoff,
+    for any HTTP verb (the shipment call is a POST). Read timeouts are not retried:
+    PostNL may have created the shipment already, and a second POST would create
+    another one with a new barcode. """
+    retry_kwargs = {
+        "total": max_retries,
+        "read": 0,
+        "backoff_factor": backoff_factor,
+        "status_forcelist": POSTNL_RETRY_STATUSES,
+        "raise_on_status": False,
+    }
+    try:
+        return Retry(allowed_methods=None, **retry_kwargs)
+    except TypeError:  # urllib3 < 1.26
+        return Retry(method_whitelist=False, **retry_kwargs)
+
+
+def get_label_file_type(printer_type):
+    """ Returns the file type of the labels printed for the given printer type. """
+    if printer_type and printer_type.startswith("Zebra|"):
+        return "zpl"
+    return "pdf"
+
+
+def get_session(api_url, apikey, pool_size=10, max_retries=3, backoff_factor=0.5):
+    """ Returns the pooled session for the given API URL and key, creating it on first use. """
+    key = (api_url, apikey, pool_size, max_retries, backoff_factor)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+                max_retries=_get_retry(max_retries, backoff_factor))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[key] = session
+    return session
 
 
 class PostNLAPI():
 
-    def __init__(self, shipping_api_url, apikey, confirm_shipment):
+    def __init__(self, shipping_api_url, apikey, confirm_shipment, max_workers=1, batch_size=1,
+                 pool_size=10, timeout=(10, 60), max_retries=3, backoff_factor=0.5, status_api_url=None,
+                 barcode_api_url=None, throttle=None):
         self.apikey = apikey
+        self.throttle = throttle
+        self.status_api_url = status_api_url
+        self.barcode_api_url = barcode_api_url
+        self.max_workers = max(max_workers or 1, 1)
+        self.batch_size = max(batch_size or 1, 1)
+        self.timeout = timeout
         if confirm_shipment:
             confirm_param = "?confirm=true"
         else:
             confirm_param = "?confirm=false"
         self.shipping_api_url = "{}{}".format(shipping_api_url, confirm_param)
+        self.session_key = (shipping_api_url, apikey, pool_size, max_retries, backoff_factor)
+
+    @property
+    def session(self):
+        """ The process-wide pooled session of the client settings. Clients are kept
+        across calls, so the session is looked up rather than held by the instance. """
+        return get_session(*self.session_key)
 
-    def send_postnl_package(self, pickings):
+    def send_postnl_package(self, pickings, stats=None, raise_on_error=True):
         """ Generates the shipment towards PostNL
             Using the Shipping webservice (/v1/shipment endpoint).
+
+            All the addresses are validated before any call is made. Up to `batch_size`
+            pickings are packed into the Shipments of one message. A picking with several
+            packages is sent as one multi-collo shipment, with a barcode and labels per package. Request bodies are
+            composed and responses are processed in the calling thread, as both need
+            the ORM. Only the HTTP calls are sent concurrently, when more than one worker
+            is configured. The result keeps the order of the pickings.
+
+            With `raise_on_error`, any invalid address or failed shipment raises a
+            UserError listing the failing pickings. Otherwise, only the valid pickings
+            are sent and each result has an `error` key, False for the shipments that
+            were created, so the caller can keep those and retry the others.
+
+            When a `stats` list is given, one entry per HTTP call is appended to it,
+            with the timings of the payload building, the call and the label attachment.
         """
-        result = []
-        for picking in pickings:
-            self._validate_address(picking)
+        start = time.perf_counter()
+        prepared_shipments, errors = self._prepare_shipments(pickings)
+        if errors and raise_on_error:
+            raise UserError(self._format_errors(pickings, errors))
+
+        # shipments created by an earlier, interrupted or rolled back, attempt are not sent again
+        ShipmentLog = pickings.env["postnl.shipment.log"]
+        keys = {
+            picking_id: self._get_idempotency_key(picking_id, prepared_shipment)
+            for picking_id, prepared_shipment in prepared_shipments.items()
+        }
+        logged_shipments = ShipmentLog._get_logged_shipments(keys.values())
+        shipping_data_by_picking = {}
+        for picking in pickings.filtered(lambda picking: keys.get(picking.id) in logged_shipments):
+            shipping_data_by_picking[picking.id] = logged_shipments[keys[picking.id]].with_context(
+                postnl_label_file_type=get_label_file_type(prepared_shipments[picking.id]["printer_type"]),
+            )._replay(picking)
+
+        batches = self._split_in_batches(pickings.filtered(
+            lambda picking: picking.id in prepared_shipments and picking.id not in shipping_data_by_picking))
+        prepare_time = (time.perf_counter() - start) / len(batches) if batches else 0.0
+        requests_data = []
+        build_times = []
+        for batch in batches:
+            start = time.perf_counter()
+            requests_data.append(json.dumps(self._get_shipment_request_body(batch, prepared_shipments)))
+            build_times.append(time.perf_counter() - start + prepare_time)
 
-            response = requests.request(
-                method="POST",
-                url=self.shipping_api_url,
-                headers={"apikey": self.apikey},
-                data=self._get_shipment_request_body(picking))
+        posted_shipments = zip(batches, requests_data, build_times, self._post_shipments(requests_data))
+        for batch, data, build_time, (response, http_time, exception) in posted_shipments:
+            start = time.perf_counter()
+            batch_errors = {}
             try:
+                if exception:
+                    raise exception
                 response.raise_for_status()
                 response_body = response.json()
             except Exception as e:
-                raise UserError(
-                    _("PostNL API - invalid response! %s" % str(e))
-                )
-            carrier_tracking_ref = self._get_shipment_barcode(response_body)
-            labels = self._get_shipment_labels(response_body, picking)
-            picking.attach_postnl_labels(labels)
-
-            shipping_data = {
-                "exact_price": 0,  # PostNL does not provide the cost
-                "tracking_number": carrier_tracking_ref,
-                "labels": labels,
+                batch_errors.update((picking.id, str(e)) for picking in batch)
+            else:
+                response_shipments = self._map_response_shipments(response_body, batch, prepared_shipments)
+                for picking in batch:
+                    prepared_shipment = prepared_shipments[picking.id]
+                    colli = self._sort_response_colli(
+                        response_shipments.get(picking.name) or [], prepared_shipment["shipments"])
+                    error = next(filter(None, map(self._get_shipment_error, colli)), False)
+                    if error:
+                        batch_errors[picking.id] = error
+                        continue
+                    carrier_tracking_ref = self._get_shipment_barcode(colli[0])
+                    labels = picking.attach_postnl_labels(
+                        label
+                        for response_shipment, package_id in zip(colli, prepared_shipment["package_ids"])
+                        for label in self._get_shipment_labels(response_shipment, picking, package_id)
+                    )
+                    ShipmentLog._log_shipment(
+                        keys[picking.id], picking, carrier_tracking_ref, labels,
+                        barcodes=self._get_colli_barcodes(prepared_shipment["shipments"], colli))
+
+                    shipping_data_by_picking[picking.id] = {
+                        "exact_price": 0,  # PostNL does not provide the cost
+                        "tracking_number": carrier_tracking_ref,
+                        "label_attachment_ids": labels.mapped("attachment_id").ids,
+                        "error": False,
+                    }
+            errors.update(batch_errors)
+            if stats is not None:
+                stats.append({
+                    "picking_ids": batch.ids,
+                    "build_time": build_time,
+                    "http_time": http_time,
+                    "attach_time": time.perf_counter() - start,
+                    "status_code": response is not None and response.status_code or 0,
+                    "payload_size": len(data),
+                    "retry_count": self._get_retry_count(response),
+                    "error": self._format_errors(batch, batch_errors),
+                })
+        if errors and raise_on_error:
+            raise UserError(
+                _("PostNL API - invalid response! %s") % self._format_errors(pickings, errors)
+            )
+        return [
+            shipping_data_by_picking.get(picking.id) or {
+                "exact_price": 0,
+                "tracking_number": False,
+                "label_attachment_ids": [],
+                "error": errors[picking.id],
             }
-            result.append(shipping_data)
+            for picking in pickings
+        ]
+
+    def _get_idempotency_key(self, picking_id, prepared_shipment):
+        """ Hashes what identifies a shipment: the endpoint, the picking and its payload,
+        without the message timestamp and the barcodes. Barcodes fetched or reserved in a
+        transaction that is rolled back are replaced on the next attempt, which must still
+        find the logged shipment. """
+        content = json.dumps({
+            "url": self.shipping_api_url,
+            "picking_id": picking_id,
+            "customer": prepared_shipment["customer"],
+            "printer_type": prepared_shipment["printer_type"],
+            "shipments": [
+                {key: value for key, value in shipment.items() if key not in ("Barcode", "Groups")}
+                for shipment in prepared_shipment["shipments"]
+            ],
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _get_colli_barcodes(self, shipments, response_shipments):
+        """ Returns the barcodes sent and received for the colli of a picking. """
+        barcodes = [shipment["Barcode"] for shipment in shipments if shipment.get("Barcode")]
+        barcodes += [self._get_shipment_barcode(response_shipment) for response_shipment in response_shipments]
+        return sorted(set(barcodes))
+
+    def _format_errors(self, pickings, errors):
+        """ Lists the errors of the pickings, one per line. """
+        return "\n".join(
+            "{}: {}".format(picking.name, errors[picking.id]) for picking in pickings if picking.id in errors
+        )
+
+    def _split_in_batches(self, pickings):
+        """ Splits the pickings in batches of at most `batch_size` pickings sharing
+        the same company and carrier, as those make up the Customer of the message. """
+        batches = []
+        open_batches = {}
+        for picking in pickings:
+            key = (picking.company_id.id, picking.carrier_id.id)
+            batch = open_batches.get(key)
+            if batch is None or len(batch) >= self.batch_size:
+                batch = open_batches[key] = []
+                batches.append(batch)
+            batch.append(picking)
+        return [pickings.browse([picking.id for picking in batch]) for batch in batches]
+
+    def _post_shipments(self, requests_data):
+        """ Posts the request bodies, yielding (response, duration, exception) tuples
+        in the same order. """
+        return self._run_concurrently(self._post_shipment, requests_data)
+
+    def _post_shipment(self, data):
+        """ Sends a single /v1/shipment call. """
+        return self._request("POST", self.shipping_api_url, data=data)
+
+    def _run_concurrently(self, func, items):
+        """ Applies `func` to the items, in a thread pool when more than one worker is
+        configured, yielding the results in the order of the items. """
+        if self.max_workers == 1 or len(items) <= 1:
+            for item in items:
+                yield func(item)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as executor:
+            for item_result in executor.map(func, items):
+                yield item_result
+
+    def _request(self, method, url, data=None):
+        """ Sends a call through the pooled session. Runs outside of the Odoo cursor thread,
+        so it must not touch the ORM; errors are returned to be reported by the caller.
+
+        :return tuple: (response or None, duration in seconds, exception or None)
+        """
+        start = time.perf_counter()
+        headers = {"apikey": self.apikey}
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+        try:
+            if self.throttle:
+                self.throttle()
+                # the wait for the shared rate limit is not counted in the call duration
+                start = time.perf_counter()
+            response = self.session.request(
+                method=method,
+                url=url,
+                headers=headers,
+                data=data,
+                timeout=self.timeout)
+        except Exception as e:
+            return None, time.perf_counter() - start, e
+        return response, time.perf_counter() - start, None
+
+    def get_shipment_statuses(self, barcodes):
+        """ Retrieves the status of shipments
+            Using the Shippingstatus webservice (/shipment/v2/status/barcode endpoint),
+            concurrently when more than one worker is configured.
+
+        :param barcodes: list of shipment barcodes
+        :return dict: {barcode: {"code", "description", "timestamp", "events"}}, or
+                      {barcode: {"error": message}} for the failed calls
+        """
+        result = {}
+        statuses = self._run_concurrently(self._get_shipment_status, barcodes)
+        for barcode, (response, duration, exception) in zip(barcodes, statuses):
+            try:
+                if exception:
+                    raise exception
+                response.raise_for_status()
+                result[barcode] = self._parse_shipment_status(response.json())
+            except Exception as e:
+                result[barcode] = {"error": str(e)}
         return result
 
-    def _validate_address(self, picking):
-        """ Validates the address before suppplying it to PostNL """
-        if not picking.partner_id.country_id:
-            raise UserError(
-                    _("Partner address does not have a country set! ")
-                )
-        elif picking.partner_id.country_id.code != 'NL':
-            raise UserError(
-                    _("PostNL integration is only supported for packages to NL! ")
-                )
-        elif not picking.partner_id.city:
-            raise UserError(
-                    _("Partner address does not have mandatory information - city! ")
-                )
-        elif not picking.partner_id.zip:
-            raise UserError(
-                    _("Partner address does not have mandatory information - zip! ")
-                )
+    def _get_shipment_status(self, barcode):
+        return self._request("GET", "{}/{}?detail=true".format(self.status_api_url, barcode))
 
-    def _get_shipment_request_body(self, picking):
-        """ Composes the request body/payload for the /v1/shipment call. """
+    def _parse_shipment_status(self, response_body):
+        """ Retrieves the current status and the events from a status response. """
+        status_body = response_body.get("CompleteStatus") or response_body.get("CurrentStatus") or {}
+        shipment = status_body.get("Shipment") or {}
+        if isinstance(shipment, list):
+            shipment = shipment and shipment[0] or {}
+        status = shipment.get("Status") or {}
+        events = shipment.get("Event") or []
+        if isinstance(events, dict):
+            events = [events]
+        return {
+            "code": status.get("StatusCode"),
+            "description": status.get("StatusDescription"),
+            "timestamp": status.get("TimeStamp"),
+            "events": events,
+        }
+
+    def generate_barcodes(self, customer_code, customer_number, barcode_type, serie, count):
+        """ Generates barcodes ahead of the shipments
+            Using the Barcode webservice (/shipment/v1_1/barcode endpoint), which returns
+            one barcode per call; the calls are sent concurrently when more than one worker
+            is configured.
+
+        :return tuple: (list of barcodes, list of error messages)
+        """
+        params = {
+            "CustomerCode": customer_code,
+            "CustomerNumber": customer_number,
+            "Type": barcode_type,
+            "Serie": serie,
+        }
+        url = "{}?{}".format(self.barcode_api_url, urlencode(params))
+        barcodes = []
+        errors = []
+        for response, duration, exception in self._run_concurrently(lambda i: self._request("GET", url), range(count)):
+            try:
+                if exception:
+                    raise exception
+                response.raise_for_status()
+                barcodes.append(response.json()["Barcode"])
+            except Exception as e:
+                errors.append(str(e))
+        return barcodes, errors
+
+    def _get_retry_count(self, response):
+        """ Returns how many times the call was retried by the session. """
+        retries = response is not None and getattr(response.raw, "retries", None)
+        return len(retries.history) if isinstance(retries, Retry) else 0
+
+    def _get_address_error(self, partner_vals, country_code):
+        """ Returns the reason why an address cannot be supplied to PostNL, if any. """
+        if not partner_vals.get("country_id"):
+            return _("Partner address does not have a country set! ")
+        elif country_code != 'NL':
+            return _("PostNL integration is only supported for packages to NL! ")
+        elif not partner_vals.get("city"):
+            return _("Partner address does not have mandatory information - city! ")
+        elif not partner_vals.get("zip"):
+            return _("Partner address does not have mandatory information - zip! ")
+        return False
+
+    def _prepare_shipments(self, pickings):
+        """ Prepares the payload data of all the pickings in one pass, reading the pickings,
+        partners, companies and carriers in a few batched queries. The sender (Customer)
+        block is built once per company and carrier.
+
+        :return tuple: ({picking id: {"customer": ..., "printer_type": ..., "shipments": [...],
+                                      "package_ids": [package id of each shipment, or False]}},
+                        {picking id: validation error})
+        """
+        def _id(value):
+            return value and value[0]
+
+        picking_vals_list = pickings.read(POSTNL_PICKING_FIELDS)
+        partners = pickings.mapped("partner_id")
+        companies = pickings.mapped("company_id")
+        carriers = pickings.mapped("carrier_id")
+        partner_vals = {vals["id"]: vals for vals in partners.read(POSTNL_PARTNER_FIELDS)}
+        company_vals = {vals["id"]: vals for vals in companies.read(POSTNL_COMPANY_FIELDS)}
+        carrier_vals = {vals["id"]: vals for vals in carriers.read(POSTNL_CARRIER_FIELDS)}
+        country_codes = {
+            country.id: country.code
+            for country in partners.mapped("country_id") | companies.mapped("country_id")
+        }
+        weight_factor = pickings.env["delivery.carrier"]._get_postnl_weight_uom_factor()
+        colli_by_picking = self._get_colli(pickings, weight_factor)
+
+        customers = {}
+        prepared_shipments = {}
+        errors = {}
+        for picking_vals in picking_vals_list:
+            partner = partner_vals.get(_id(picking_vals["partner_id"]))
+            if not partner:
+                errors[picking_vals["id"]] = _("The transfer has no partner! ")
+                continue
+            partner_country_code = country_codes.get(_id(partner["country_id"]))
+            error = self._get_address_error(partner, partner_country_code)
+            if error:
+                errors[picking_vals["id"]] = error
+                continue
+
+            company = company_vals[_id(picking_vals["company_id"])]
+            carrier = carrier_vals.get(_id(picking_vals["carrier_id"])) or dict.fromkeys(POSTNL_CARRIER_FIELDS, False)
+            customer_key = (company["id"], _id(picking_vals["carrier_id"]))
+            if customer_key not in customers:
+                customers[customer_key] = self._get_customer_data(
+                    company, country_codes.get(_id(company["country_id"])), carrier)
+            shipment = self._get_shipment_data(
+                picking_vals, partner, partner_country_code, carrier, picking_vals["shipping_weight"] * weight_factor)
+            colli = colli_by_picking.get(picking_vals["id"])
+            if colli and not all(barcode for package_id, weight, barcode in colli):
+                errors[picking_vals["id"]] = _("A multi-collo shipment needs a barcode for each package! ")
+                continue
+            prepared_shipments[picking_vals["id"]] = {
+                "customer": customers[customer_key],
+                "printer_type": carrier["postnl_printer_type"] or POSTNL_MESSAGE_PRINTER_TYPE,
+                "shipments": colli and self._get_multi_collo_shipments(shipment, colli) or [shipment],
+                "package_ids": colli and [package_id for package_id, weight, barcode in colli] or [False],
+            }
+        return prepared_shipments, errors
+
+    def _get_colli(self, pickings, weight_factor):
+        """ Returns {picking id: [(package id, weight in kg, barcode)]} for the pickings with
+        several packages, reading the packages and their reserved barcodes in batch. """
+        packages_by_picking = {
+            picking_id: packages
+            for picking_id, packages in pickings._get_postnl_packages().items()
+            if len(packages) > 1
+        }
+        if not packages_by_picking:
+            return {}
+        packages = pickings.env["stock.quant.package"].browse(
+            [package.id for packages in packages_by_picking.values() for package in packages])
+        weights = {
+            vals["id"]: vals["shipping_weight"] or vals["weight"]
+            for vals in packages.read(["shipping_weight", "weight"])
+        }
+        barcodes = {
+            vals["package_id"][0]: vals["name"]
+            for vals in pickings.env["postnl.barcode"].sudo().search_read(
+                [("package_id", "in", packages.ids), ("state", "=", "reserved")], ["name", "package_id"])
+        }
+        return {
+            picking_id: [
+                (package.id, weights[package.id] * weight_factor, barcodes.get(package.id))
+                for package in packages
+            ]
+            for picking_id, packages in packages_by_picking.items()
+        }
+
+    def _get_multi_collo_shipments(self, shipment, colli):
+        """ Splits the shipment of a picking in one shipment per package, grouped under the
+        barcode of the first package. """
+        main_barcode = colli[0][2]
+        shipments = []
+        for sequence, (package_id, weight, barcode) in enumerate(colli, 1):
+            shipments.append(dict(
+                shipment,
+                Barcode=barcode,
+                Dimension={"Weight": str(weight * 1000)},  # weight in grams
+                Groups=[{
+                    "GroupType": "03",  # multi-collo
+                    "GroupSequence": str(sequence),
+                    "GroupCount": str(len(colli)),
+                    "MainBarcode": main_barcode,
+                }],
+            ))
+        return shipments
+
+    def _get_shipment_request_body(self, pickings, prepared_shipments):
+        """ Composes the request body/payload for the /v1/shipment call,
+        with one shipment per picking, or per package of the multi-collo pickings. """
+        prepared_shipment = prepared_shipments[pickings[0].id]
         shipment = {
-            "Customer": {
-                "Address": {
-                        "AddressType": POSTNL_CUSTOMER_ADDRESS_TYPE,  # sender address type
-                        "City": picking.company_id.city,
-                        "CompanyName": picking.company_id.name,
-                        "Countrycode": picking.company_id.country_id.code,
-                        "HouseNr": "42",
-                        "Street": picking.company_id.street,
-                        "Zipcode": picking.company_id.zip
-                    },
-                "CollectionLocation": "",
-                "ContactPerson": "",
-                "CustomerCode": picking.carrier_id.postnl_customer_code,
-                "CustomerNumber": picking.carrier_id.postnl_customer_number,
-                "Email": picking.company_id.email,
-                "Name": picking.company_id.name,
-            },
+            "Customer": prepared_shipment["customer"],
             "Message": {
-                "MessageID": str(picking.id),
+                "MessageID": str(pickings[0].id),
                 "MessageTimeStamp": fields.Datetime.now().strftime('%d-%m-%Y %H:%M:%S'),
-                "Printertype": POSTNL_MESSAGE_PRINTER_TYPE,
+                "Printertype": prepared_shipment["printer_type"],
             },
-            "Shipments": {
-                "Addresses": [
-                {
-                    "AddressType": POSTNL_SHIPMENTS_ADDRESS_TYPE,  # receiver address type
-                    "City": picking.partner_id.city,
-                    "Countrycode": picking.partner_id.country_id.code,
-                    "FirstName": "",
-                    "HouseNr": picking.partner_id.street_number,
-                    "HouseNrExt": picking.partner_id.street_number2,
-                    "Name": picking.partner_id.name,
-                    "Street": picking.partner_id.street,
-                    "Zipcode": picking.partner_id.zip,
-                }
-                ],
-                "Contacts": [
-                {
-                    "ContactType": POSTNL_CONTACT_ADDRESS_TYPE,
-                    "Email": picking.partner_id.email,
-                    "SMSNr": picking.partner_id.mobile,
-                    "TelNr": picking.partner_id.phone,
-                }
-                ],
-                "Dimension": {
-                    "Weight": str(picking.carrier_id._convert_weight_to_kg(picking.shipping_weight) * 1000)
-                },  # weight in grams
-                "ProductCodeDelivery": "3085"  # Standard shipment
+            "Shipments": [
+                shipment for picking in pickings for shipment in prepared_shipments[picking.id]["shipments"]
+            ],
+        }
+        return shipment
+
+    def _get_customer_data(self, company, country_code, carrier):
+        """ Composes the sender (Customer) block of the request body. """
+        return {
+            "Address": {
+                    "AddressType": POSTNL_CUSTOMER_ADDRESS_TYPE,  # sender address type
+                    "City": company["city"],
+                    "CompanyName": company["name"],
+                    "Countrycode": country_code,
+                    "HouseNr": "42",
+                    "Street": company["street"],
+                    "Zipcode": company["zip"]
+                },
+            "CollectionLocation": "",
+            "ContactPerson": "",
+            "CustomerCode": carrier["postnl_customer_code"],
+            "CustomerNumber": carrier["postnl_customer_number"],
+            "Email": company["email"],
+            "Name": company["name"],
+        }
+
+    def _get_shipment_data(self, picking, partner, country_code, carrier, weight):
+        """ Composes a single entry of the Shipments of the request body,
+        from the values read for the picking, its partner and carrier, and its weight in kg. """
+        shipment = {
+            "Addresses": [
+            {
+                "AddressType": POSTNL_SHIPMENTS_ADDRESS_TYPE,  # receiver address type
+                "City": partner["city"],
+                "Countrycode": country_code,
+                "FirstName": "",
+                "HouseNr": partner["street_number"],
+                "HouseNrExt": partner["street_number2"],
+                "Name": partner["name"],
+                "Street": partner["street"],
+                "Zipcode": partner["zip"],
             }
+            ],
+            "Contacts": [
+            {
+                "ContactType": POSTNL_CONTACT_ADDRESS_TYPE,
+                "Email": partner["email"],
+                "SMSNr": partner["mobile"],
+                "TelNr": partner["phone"],
+            }
+            ],
+            "Dimension": {
+                "Weight": str(weight * 1000)
+            },  # weight in grams
+            "ProductCodeDelivery": carrier["postnl_product_code"] or "3085",  # Standard shipment
+            "Reference": picking["name"],
         }
+        if picking["postnl_barcode_id"]:
+            shipment["Barcode"] = picking["postnl_barcode_id"][1]  # reserved from the barcode pool
         return shipment
 
-    def _get_shipment_barcode(self, response_body):
-        """ Retrieves the barcode from the response. """
-        result = ""
-        if response_body:
-            response_body = response_body.get("ResponseShipments", [])
-            result = response_body[0].get("Barcode")  # take the first shipment
+    def _map_response_shipments(self, response_body, pickings, prepared_shipments):
+        """ Maps the ResponseShipments back to the picking names, as lists holding the
+        colli of each picking. Shipments are matched by their Reference, falling back on
+        their position in the message. """
+        result = {}
+        response_shipments = response_body and response_body.get("ResponseShipments") or []
+        picking_names = [
+            picking.name for picking in pickings for shipment in prepared_shipments[picking.id]["shipments"]
+        ]
+        for picking_name, response_shipment in zip(picking_names, response_shipments):
+            reference = response_shipment.get("Reference") or picking_name
+            result.setdefault(reference, []).append(response_shipment)
         return result
 
-    def _get_shipment_labels(self, response_body, picking):
-        """ Retrieves the labels from the response. """
-        result =[]
-        if response_body:
-            response_body = response_body.get("ResponseShipments", [])
-            labels = response_body[0].get("Labels", [])
-            file_type = "pdf"
-            for label in labels:
-                res_label = {
-                    "name": picking.name,
-                    "file": label["Content"],
-                    "filename": "{}.{}".format(picking.name, file_type),
-                    "file_type": file_type,
-                }
-                result.append(res_label)
-        return result
+    def _sort_response_colli(self, response_shipments, shipments):
+        """ Orders the response shipments of a picking like the shipments sent for it,
+        by barcode when they were sent with one. Missing colli are None. """
+        by_barcode = {response_shipment.get("Barcode"): response_shipment for response_shipment in response_shipments}
+        barcodes = [shipment.get("Barcode") for shipment in shipments]
+        if all(barcodes) and all(barcode in by_barcode for barcode in barcodes):
+            return [by_barcode[barcode] for barcode in barcodes]
+        return (response_shipments + [None] * len(shipments))[:len(shipments)]
+
+    def _get_shipment_error(self, response_shipment):
+        """ Returns the error message of a response shipment, if any. """
+        if not response_shipment:
+            return _("Shipment missing from the response!")
+        errors = response_shipment.get("Errors") or []
+        if errors:
+            return ", ".join(
+                error.get("Description") or error.get("Error") or str(error) for error in errors
+            )
+        if not response_shipment.get("Barcode"):
+            return _("Shipment has no barcode!")
+        return False
+
+    def _get_shipment_barcode(self, response_shipment):
+        """ Retrieves the barcode from a response shipment. """
+        return response_shipment.get("Barcode", "")
+
+    def _get_shipment_labels(self, response_shipment, picking, package_id=False):
+        """ Yields the labels of a response shipment one by one. The content is taken out
+        of the response, so the labels are only held in memory until they are attached.
+        The labels of a collo are named after its barcode and linked to its package. """
+        file_type = get_label_file_type(picking.carrier_id.postnl_printer_type)
+        barcode = self._get_shipment_barcode(response_shipment)
+        for label in response_shipment.get("Labels", []):
+            label_values = {
+                "name": picking.name,
+                "file": label.pop("Content"),
+                "filename": "{}.{}".format(picking.name, file_type),
+                "file_type": file_type,
+            }
+            if package_id:
+                label_values.update({
+                    "filename": "{}-{}.{}".format(picking.name, barcode, file_type),
+                    "package_id": package_id,
+                    "tracking_number": barcode,
+                })
+            yield label_values
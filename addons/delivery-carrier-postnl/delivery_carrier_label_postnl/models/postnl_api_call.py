@@ -0,0 +1,93 @@
+import logging
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+
+class PostNLAPICall(models.Model):
+    _name = "postnl.api.call"
+    _description = "PostNL API Call"
+    _order = "id desc"
+
+    carrier_id = fields.Many2one("delivery.carrier", string="Carrier", index=True, ondelete="cascade")
+    # plain names, not a Many2many: the call is logged on its own cursor, where the
+    # pickings of the current transaction may not exist yet
+    picking_names = fields.Text(string="Transfers")
+    picking_count = fields.Integer(string="Transfers Count")
+    success = fields.Boolean(string="Success", index=True)
+    status_code = fields.Integer(string="HTTP Status")
+    payload_size = fields.Integer(string="Payload Size (bytes)")
+    retry_count = fields.Integer(string="Retries")
+    build_time = fields.Float(string="Payload Building (ms)", digits=(16, 1))
+    http_time = fields.Float(string="API Call (ms)", digits=(16, 1))
+    attach_time = fields.Float(string="Label Attachment (ms)", digits=(16, 1))
+    error = fields.Text(string="Error")
+
+    @api.model
+    def _log_calls(self, carrier, stats):
+        """ Stores the stats collected by `PostNLAPI.send_postnl_package`. They are written
+        with a separate cursor, so calls that end in an error are kept after the rollback. """
+        if not stats:
+            return
+        Picking = carrier.env["stock.picking"]
+        vals_list = [{
+            "carrier_id": carrier.id,
+            "picking_names": ", ".join(Picking.browse(stat["picking_ids"]).mapped("name")),
+            "picking_count": len(stat["picking_ids"]),
+            "success": not stat["error"],
+            "status_code": stat["status_code"],
+            "payload_size": stat["payload_size"],
+            "retry_count": stat["retry_count"],
+            "build_time": stat["build_time"] * 1000,
+            "http_time": stat["http_time"] * 1000,
+            "attach_time": stat["attach_time"] * 1000,
+            "error": stat["error"] or False,
+        } for stat in stats]
+        try:
+            with self.pool.cursor() as cr:
+                self.with_env(self.env(cr=cr)).sudo().create(vals_list)
+        except Exception:
+            _logger.exception("Could not log the PostNL API calls")
+
+    @api.model
+    def get_postnl_metrics(self, hours=24):
+        """ Aggregates the calls of the last `hours` per carrier.
+
+        :return list: dictionaries with the carrier, the number of calls and errors, the
+                      error rate, the retries and the p50/p95/p99 of the API call time (ms)
+        """
+        self.env.cr.execute("""
+            SELECT carrier_id,
+                   COUNT(*),
+                   COUNT(*) FILTER (WHERE NOT success),
+                   COALESCE(SUM(retry_count), 0),
+                   SUM(picking_count),
+                   percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY http_time)
+            FROM postnl_api_call
+            WHERE create_date >= %s
+            GROUP BY carrier_id
+        """, (fields.Datetime.now() - timedelta(hours=hours),))
+        carriers = {carrier.id: carrier for carrier in self.env["delivery.carrier"].sudo().search([])}
+        result = []
+        for carrier_id, call_count, error_count, retry_count, picking_count, percentiles in self.env.cr.fetchall():
+            result.append({
+                "carrier_id": carrier_id,
+                "carrier_name": carrier_id in carriers and carriers[carrier_id].name or "",
+                "call_count": call_count,
+                "error_count": error_count,
+                "error_rate": float(error_count) / call_count,
+                "retry_count": retry_count,
+                "picking_count": picking_count or 0,
+                "p50": percentiles[0],
+                "p95": percentiles[1],
+                "p99": percentiles[2],
+            })
+        return result
+
+    @api.model
+    def _cron_cleanup(self):
+        """ Removes the calls older than `postnl_api_call_retention_days` days. """
+        days = int(self.env["ir.config_parameter"].sudo().get_param("postnl_api_call_retention_days", default=30))
+        self.search([("create_date", "<", fields.Datetime.now() - timedelta(days=days))]).unlink()
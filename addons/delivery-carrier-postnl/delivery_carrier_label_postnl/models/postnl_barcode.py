@@ -0,0 +1,111 @@
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+
+class PostNLBarcode(models.Model):
+    _name = "postnl.barcode"
+    _description = "PostNL Barcode"
+    _order = "id"
+
+    name = fields.Char(string="Barcode", required=True, readonly=True)
+    carrier_id = fields.Many2one("delivery.carrier", string="Carrier", required=True, readonly=True, ondelete="cascade")
+    customer_code = fields.Char(string="Customer Code", required=True, readonly=True)
+    barcode_type = fields.Char(string="Type", required=True, readonly=True)
+    serie = fields.Char(string="Serie", required=True, readonly=True)
+    picking_id = fields.Many2one("stock.picking", string="Transfer", readonly=True, ondelete="set null")
+    package_id = fields.Many2one("stock.quant.package", string="Package", readonly=True, ondelete="set null")
+    state = fields.Selection(
+        [("available", "Available"), ("reserved", "Reserved")],
+        string="Status", default="available", required=True, readonly=True)
+
+    _sql_constraints = [
+        ("name_uniq", "unique(name)", "A PostNL barcode can only be stored once!"),
+    ]
+
+    def init(self):
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS postnl_barcode_available_idx
+            ON postnl_barcode (carrier_id, customer_code, barcode_type, serie, id)
+            WHERE state = 'available'
+        """)
+
+    @api.model
+    def _get_pool_domain(self, carrier):
+        return [
+            ("carrier_id", "=", carrier.id),
+            ("customer_code", "=", carrier.postnl_customer_code),
+            ("barcode_type", "=", carrier.postnl_barcode_type),
+            ("serie", "=", carrier.postnl_barcode_serie),
+        ]
+
+    @api.model
+    def _refill(self, carrier):
+        """ Fetches barcodes in bulk until the pool of the carrier's customer code, type
+        and serie holds `postnl_barcode_pool_size` available barcodes. The available barcodes
+        of shipments logged while their reservation was rolled back are retired first. """
+        self.env.cr.execute("""
+            UPDATE postnl_barcode barcode SET state = 'reserved'
+            WHERE barcode.carrier_id = %s AND barcode.state = 'available'
+              AND EXISTS (SELECT 1 FROM postnl_shipment_log_barcode used WHERE used.name = barcode.name)
+        """, (carrier.id,))
+        self.invalidate_cache(["state"])
+        available_count = self.search_count(self._get_pool_domain(carrier) + [("state", "=", "available")])
+        missing_count = carrier.postnl_barcode_pool_size - available_count
+        if missing_count > 0:
+            self._fetch(carrier, missing_count)
+
+    @api.model
+    def _fetch(self, carrier, count):
+        barcodes, errors = carrier._get_postnl_api().generate_barcodes(
+            carrier.postnl_customer_code, carrier.postnl_customer_number,
+            carrier.postnl_barcode_type, carrier.postnl_barcode_serie, count)
+        if errors and not barcodes:
+            raise UserError(_("PostNL API - barcodes could not be generated! %s") % errors[0])
+        return self.sudo().create([{
+            "name": barcode,
+            "carrier_id": carrier.id,
+            "customer_code": carrier.postnl_customer_code,
+            "barcode_type": carrier.postnl_barcode_type,
+            "serie": carrier.postnl_barcode_serie,
+        } for barcode in barcodes])
+
+    @api.model
+    def _reserve(self, carrier, pickings):
+        """ Hands out an available barcode to each picking without one, and to each of its
+        packages when it has several. The barcodes are taken under row locks, skipping
+        those locked by a concurrent reservation, so no barcode is given twice. When the
+        pool runs dry, the missing barcodes are fetched from PostNL right away.
+
+        A reservation rolled back after its shipment was created puts the barcode back in
+        the pool, so the barcodes of the logged shipments, committed on their own, are
+        skipped. """
+        pickings = pickings.filtered(lambda picking: not picking.postnl_barcode_id)
+        if not pickings:
+            return
+        packages_by_picking = pickings._get_postnl_packages()
+        count = sum(max(len(packages), 1) for packages in packages_by_picking.values())
+        self.env.cr.execute("""
+            SELECT id FROM postnl_barcode
+            WHERE carrier_id = %s AND customer_code = %s AND barcode_type = %s AND serie = %s
+              AND state = 'available'
+              AND NOT EXISTS (SELECT 1 FROM postnl_shipment_log_barcode used WHERE used.name = postnl_barcode.name)
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, (
+            carrier.id, carrier.postnl_customer_code, carrier.postnl_barcode_type,
+            carrier.postnl_barcode_serie, count))
+        barcodes = self.browse([row[0] for row in self.env.cr.fetchall()])
+        if len(barcodes) < count:
+            barcodes |= self._fetch(carrier, count - len(barcodes))
+            if len(barcodes) < count:
+                raise UserError(_("PostNL API - not enough barcodes could be generated!"))
+        barcodes = iter(barcodes)
+        for picking in pickings:
+            packages = packages_by_picking[picking.id]
+            # a single package shares the barcode of its picking
+            for package in packages if len(packages) > 1 else [packages]:
+                barcode = next(barcodes)
+                barcode.sudo().write({"state": "reserved", "picking_id": picking.id, "package_id": package.id})
+                if not picking.postnl_barcode_id:
+                    picking.postnl_barcode_id = barcode
@@ -0,0 +1,46 @@
+from odoo import api, fields, models
+
+
+class PostNLRate(models.Model):
+    _name = "postnl.rate"
+    _description = "PostNL Rate"
+    _order = "carrier_id, product_code, zone, max_weight"
+
+    carrier_id = fields.Many2one("delivery.carrier", string="Carrier", required=True, index=True, ondelete="cascade")
+    product_code = fields.Char(string="Product Code", required=True, default="3085")
+    zone = fields.Char(
+        string="Destination Zone",
+        help="Country code of the destination. Leave empty to apply to any destination.")
+    max_weight = fields.Float(string="Up to Weight (kg)", required=True)
+    price = fields.Float(string="Price (EUR)", required=True)
+
+    _sql_constraints = [
+        ("band_uniq", "unique(carrier_id, product_code, zone, max_weight)",
+         "A weight band can only be defined once per carrier, product code and zone!"),
+    ]
+
+    def init(self):
+        # the unique constraint does not apply to the bands of any zone, NULL being distinct
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS postnl_rate_any_zone_band_uniq
+            ON postnl_rate (carrier_id, product_code, max_weight)
+            WHERE zone IS NULL
+        """)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.clear_caches()
+        return records
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        self.clear_caches()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
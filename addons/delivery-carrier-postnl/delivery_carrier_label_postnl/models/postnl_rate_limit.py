@@ -0,0 +1,79 @@
+import hashlib
+import logging
+import time
+
+from psycopg2.extensions import TransactionRollbackError
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+POSTNL_RATE_LIMIT_ATTEMPTS = 10
+
+
+class PostNLRateLimit(models.Model):
+    _name = "postnl.rate.limit"
+    _description = "PostNL API Rate Limit"
+
+    name = fields.Char(string="API Key Hash", required=True, readonly=True)
+    tokens = fields.Float(string="Tokens", readonly=True)
+    updated_at = fields.Datetime(string="Updated At", readonly=True)
+
+    _sql_constraints = [
+        ("name_uniq", "unique(name)", "There can only be one rate limit per API key!"),
+    ]
+
+    @api.model
+    def _get_throttle(self, apikey):
+        """ Builds the callable run by `PostNLAPI` before each call, holding it until the
+        `postnl_api_rate_limit` requests per second budget of the API key allows it.
+
+        The budget is a token bucket stored in the database, so it is shared by all the
+        workers and crons. Each call takes a token, possibly running the bucket into
+        debt, and waits until the debt is paid back: excess calls are queued in the
+        order they took their token instead of failing.
+
+        :return: a callable, or None when no rate limit is configured
+        """
+        ParamObj = self.env["ir.config_parameter"].sudo()
+        rate = float(ParamObj.get_param("postnl_api_rate_limit", default=0))
+        if rate <= 0:
+            return None
+        burst = float(ParamObj.get_param("postnl_api_rate_limit_burst", default=0)) or rate
+        name = hashlib.sha256(apikey.encode("utf-8")).hexdigest()
+        registry = self.pool
+
+        def take_token():
+            # the cursor is REPEATABLE READ: a concurrent update of the bucket fails the
+            # upsert with a serialization error, and it is simply taken again
+            for attempt in range(POSTNL_RATE_LIMIT_ATTEMPTS):
+                try:
+                    with registry.cursor() as cr:
+                        cr.execute("""
+                            INSERT INTO postnl_rate_limit AS bucket (name, tokens, updated_at)
+                            VALUES (%(name)s, %(burst)s - 1, clock_timestamp() AT TIME ZONE 'UTC')
+                            ON CONFLICT (name) DO UPDATE SET
+                                tokens = LEAST(
+                                    %(burst)s,
+                                    bucket.tokens + EXTRACT(
+                                        EPOCH FROM (clock_timestamp() AT TIME ZONE 'UTC') - bucket.updated_at
+                                    ) * %(rate)s
+                                ) - 1,
+                                updated_at = clock_timestamp() AT TIME ZONE 'UTC'
+                            RETURNING tokens
+                        """, {"name": name, "burst": burst, "rate": rate})
+                        return cr.fetchone()[0]
+                except TransactionRollbackError:
+                    if attempt == POSTNL_RATE_LIMIT_ATTEMPTS - 1:
+                        raise
+                    _logger.debug("PostNL API rate limit updated concurrently, retrying")
+
+        def throttle():
+            # runs in the HTTP worker threads, hence the dedicated cursor
+            tokens = take_token()
+            if tokens < 0:
+                wait = -tokens / rate
+                _logger.debug("PostNL API rate limit reached, waiting %.2fs", wait)
+                time.sleep(wait)
+
+        return throttle
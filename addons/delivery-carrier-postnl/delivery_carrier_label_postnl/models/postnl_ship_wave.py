@@ -0,0 +1,148 @@
+import logging
+from itertools import groupby
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+from odoo.tools.safe_eval import safe_eval
+
+_logger = logging.getLogger(__name__)
+
+
+class PostNLShipWave(models.Model):
+    _name = "postnl.ship.wave"
+    _description = "PostNL Ship Wave"
+    _order = "id desc"
+
+    name = fields.Char(string="Name", required=True, default=lambda self: _("Wave of %s") % fields.Datetime.now())
+    domain = fields.Text(
+        string="Transfers", required=True, default="[]",
+        help="Domain of the transfers to ship. Only the validated PostNL transfers without "
+             "tracking number are sent.")
+    state = fields.Selection(
+        [("draft", "Draft"), ("running", "Running"), ("done", "Done")],
+        string="Status", default="draft", required=True, readonly=True, index=True)
+    chunk_size = fields.Integer(
+        string="Chunk Size", default=lambda self: int(
+            self.env["ir.config_parameter"].sudo().get_param("postnl_ship_wave_chunk_size", default=200)),
+        help="Number of transfers sent between two commits.")
+    last_picking_id = fields.Integer(
+        string="Checkpoint", readonly=True, help="The transfers up to this id have been processed.")
+    picking_count = fields.Integer(string="Transfers Count", readonly=True)
+    processed_count = fields.Integer(string="Processed", readonly=True)
+    done_count = fields.Integer(string="Shipped", readonly=True)
+    failed_count = fields.Integer(string="Failed", readonly=True)
+    progress = fields.Float(string="Progress", compute="_compute_progress")
+    job_ids = fields.One2many("postnl.shipment.job", "wave_id", string="Shipment Jobs", readonly=True)
+    date_start = fields.Datetime(string="Started On", readonly=True)
+    date_done = fields.Datetime(string="Finished On", readonly=True)
+
+    @api.depends("processed_count", "picking_count")
+    def _compute_progress(self):
+        for wave in self:
+            wave.progress = wave.picking_count and 100.0 * wave.processed_count / wave.picking_count
+
+    @api.model
+    def ship(self, domain, name=None, chunk_size=None):
+        """ Ships the transfers of the domain right away, e.g. from `odoo shell`::
+
+            env["postnl.ship.wave"].ship([("batch_id", "=", 42)])
+
+        :return: the wave, whose run can be resumed with `_run` if it is interrupted
+        """
+        vals = {"domain": repr(domain)}
+        if name:
+            vals["name"] = name
+        if chunk_size:
+            vals["chunk_size"] = chunk_size
+        wave = self.create(vals)
+        wave.action_start()
+        self.env.cr.commit()
+        wave._run()
+        return wave
+
+    @api.multi
+    def action_start(self):
+        """ Counts the transfers to ship and hands the waves over to the scheduled action. """
+        for wave in self.filtered(lambda wave: wave.state == "draft"):
+            wave.write({
+                "state": "running",
+                "picking_count": self.env["stock.picking"].search_count(wave._get_picking_domain()),
+                "date_start": fields.Datetime.now(),
+            })
+
+    @api.multi
+    def _get_picking_domain(self):
+        self.ensure_one()
+        try:
+            domain = safe_eval(self.domain)
+        except Exception as e:
+            raise UserError(_("Invalid domain of the wave %s: %s") % (self.name, e))
+        # only validated transfers: their weight and packages are final, and their validation
+        # will not send them again
+        return domain + [
+            ("carrier_id.delivery_type", "=", "postnl"),
+            ("carrier_tracking_ref", "=", False),
+            ("state", "=", "done"),
+        ]
+
+    @api.model
+    def _cron_run_waves(self):
+        for wave in self.search([("state", "=", "running")], order="id"):
+            wave._run()
+
+    @api.multi
+    def _run(self, auto_commit=True):
+        """ Ships the transfers of the wave by chunks, in the order of their ids, committing
+        after each chunk along with the checkpoint. An interrupted run resumes after the
+        last committed chunk, and the shipment log keeps the shipments of an unfinished
+        chunk from being created twice. The wave row is locked while a chunk is processed,
+        so a concurrent run of the same wave stops instead of sending it twice. """
+        self.ensure_one()
+        while True:
+            self.env.cr.execute(
+                "SELECT id FROM postnl_ship_wave WHERE id = %s AND state = 'running' FOR UPDATE SKIP LOCKED",
+                (self.id,))
+            if not self.env.cr.fetchone():
+                break
+            # the checkpoint may have moved in a concurrent run
+            self.invalidate_cache()
+            if not self._run_chunk():
+                self.write({"state": "done", "date_done": fields.Datetime.now()})
+            _logger.info(
+                "PostNL ship wave %s: %s/%s transfers processed, %s shipped, %s failed",
+                self.name, self.processed_count, self.picking_count, self.done_count, self.failed_count)
+            if auto_commit:
+                self.env.cr.commit()
+                # keep the memory flat over thousands of transfers
+                self.invalidate_cache()
+            if self.state == "done":
+                break
+
+    @api.multi
+    def _run_chunk(self):
+        """ Sends the next chunk of transfers through shipment jobs linked to the wave, so
+        each failure keeps its error and is retried by the shipment jobs queue.
+
+        :return: False when there is nothing left to ship
+        """
+        self.ensure_one()
+        pickings = self.env["stock.picking"].search(
+            self._get_picking_domain() + [("id", ">", self.last_picking_id)],
+            order="id", limit=max(self.chunk_size, 1))
+        if not pickings:
+            return False
+        ShipmentJob = self.env["postnl.shipment.job"].sudo()
+        for carrier, carrier_pickings in groupby(pickings.sorted(lambda picking: picking.carrier_id.id),
+                                                 key=lambda picking: picking.carrier_id):
+            ShipmentJob._enqueue(carrier, pickings.browse([picking.id for picking in carrier_pickings]))
+        jobs = ShipmentJob.search([("picking_id", "in", pickings.ids), ("state", "=", "pending")])
+        jobs.write({"wave_id": self.id})
+        jobs._process()
+        done_count = len(jobs.filtered(lambda job: job.state == "done"))
+        self.write({
+            "last_picking_id": pickings[-1].id,
+            "processed_count": self.processed_count + len(pickings),
+            "done_count": self.done_count + done_count,
+            "failed_count": self.failed_count + len(jobs) - done_count,
+        })
+        return True
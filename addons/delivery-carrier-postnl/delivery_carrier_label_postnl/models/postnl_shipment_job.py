@@ -0,0 +1,120 @@
+import logging
+from itertools import groupby
+
+from odoo import api, fields, models, _
+
+_logger = logging.getLogger(__name__)
+
+
+class PostNLShipmentJob(models.Model):
+    _name = "postnl.shipment.job"
+    _description = "PostNL Shipment Job"
+    _order = "id"
+
+    picking_id = fields.Many2one("stock.picking", string="Transfer", required=True, index=True, ondelete="cascade")
+    carrier_id = fields.Many2one("delivery.carrier", string="Carrier", required=True, ondelete="cascade")
+    state = fields.Selection(
+        [("pending", "Pending"), ("done", "Done"), ("failed", "Failed")],
+        string="Status", default="pending", required=True, index=True)
+    attempt_count = fields.Integer(string="Attempts", readonly=True)
+    last_error = fields.Text(string="Last Error", readonly=True)
+    date_done = fields.Datetime(string="Sent On", readonly=True)
+    wave_id = fields.Many2one("postnl.ship.wave", string="Ship Wave", readonly=True, index=True, ondelete="set null")
+
+    def init(self):
+        # a picking has at most one job not sent yet, so its result cannot go to another job
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS postnl_shipment_job_open_picking_uniq
+            ON postnl_shipment_job (picking_id)
+            WHERE state != 'done'
+        """)
+
+    @api.model
+    def _enqueue(self, carrier, pickings):
+        """ Creates a pending job for the pickings without an open (pending or failed) job. """
+        queued_pickings = self.search([
+            ("picking_id", "in", pickings.ids),
+            ("state", "!=", "done"),
+        ]).mapped("picking_id")
+        return self.create([
+            {"picking_id": picking.id, "carrier_id": carrier.id}
+            for picking in pickings - queued_pickings
+        ])
+
+    @api.model
+    def _cron_process_jobs(self, auto_commit=True):
+        """ Drains the pending jobs in batches of `postnl_shipment_job_batch_size`,
+        committing after each batch. Jobs locked by a concurrent run are skipped. """
+        batch_size = int(self.env["ir.config_parameter"].sudo().get_param("postnl_shipment_job_batch_size", default=100))
+        last_id = 0
+        while True:
+            self.env.cr.execute("""
+                SELECT id FROM postnl_shipment_job
+                WHERE state = 'pending' AND id > %s
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (last_id, batch_size))
+            job_ids = [row[0] for row in self.env.cr.fetchall()]
+            if not job_ids:
+                break
+            last_id = job_ids[-1]
+            self.browse(job_ids)._process()
+            if auto_commit:
+                self.env.cr.commit()
+
+    @api.multi
+    def _process(self):
+        """ Sends the jobs' pickings to PostNL, one call per carrier. The valid shipments
+        are kept even when others fail, and each failing job records its own error. """
+        for carrier, jobs in groupby(self.sorted(lambda job: job.carrier_id.id), key=lambda job: job.carrier_id):
+            jobs = self.browse([job.id for job in jobs])
+            pickings = jobs.mapped("picking_id")
+            try:
+                with self.env.cr.savepoint():
+                    results = carrier.with_context(postnl_process_jobs=True).postnl_send_shipping(
+                        pickings, raise_on_error=False)
+                results = dict(zip(pickings.ids, results))
+            except Exception as e:
+                jobs._set_failed(e)
+                continue
+            for job in jobs:
+                shipping_data = results[job.picking_id.id]
+                if shipping_data["error"]:
+                    job._set_failed(shipping_data["error"])
+                else:
+                    job._set_done(shipping_data)
+
+    @api.multi
+    def _set_done(self, shipping_data):
+        """ Writes the shipment result on the picking, as `send_to_shipper` would. """
+        self.ensure_one()
+        picking = self.picking_id
+        picking.carrier_price = shipping_data["exact_price"] * (1.0 + (self.carrier_id.margin / 100.0))
+        if shipping_data["tracking_number"]:
+            picking.carrier_tracking_ref = shipping_data["tracking_number"]
+        picking.message_post(body=_("Shipment sent to carrier %s for shipping with tracking number %s") % (
+            self.carrier_id.name, picking.carrier_tracking_ref))
+        self.write({
+            "state": "done",
+            "attempt_count": self.attempt_count + 1,
+            "last_error": False,
+            "date_done": fields.Datetime.now(),
+        })
+
+    @api.multi
+    def _set_failed(self, error):
+        """ Records the error; the job stays pending until it runs out of attempts. """
+        max_attempts = int(self.env["ir.config_parameter"].sudo().get_param("postnl_shipment_job_max_attempts", default=5))
+        for job in self:
+            _logger.warning("PostNL shipment job %s for %s failed: %s", job.id, job.picking_id.name, error)
+            attempt_count = job.attempt_count + 1
+            job.write({
+                "state": "failed" if attempt_count >= max_attempts else "pending",
+                "attempt_count": attempt_count,
+                "last_error": str(error),
+            })
+
+    @api.multi
+    def action_retry(self):
+        self.filtered(lambda job: job.state == "failed").write({"state": "pending", "attempt_count": 0})
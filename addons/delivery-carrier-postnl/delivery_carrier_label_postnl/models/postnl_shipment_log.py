@@ -0,0 +1,102 @@
+import logging
+from datetime import timedelta
+
+import psycopg2
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+
+class PostNLShipmentLog(models.Model):
+    _name = "postnl.shipment.log"
+    _description = "PostNL Shipment Log"
+    _order = "id desc"
+
+    name = fields.Char(string="Idempotency Key", required=True, index=True, readonly=True)
+    # not a Many2one: the log is committed on its own, possibly before the picking itself
+    picking_name = fields.Char(string="Transfer", readonly=True)
+    barcode = fields.Char(string="Barcode", readonly=True)
+    attachment_ids = fields.One2many(
+        "ir.attachment", "res_id", string="Labels", domain=[("res_model", "=", "postnl.shipment.log")], readonly=True)
+    barcode_ids = fields.One2many("postnl.shipment.log.barcode", "log_id", string="Colli Barcodes", readonly=True)
+
+    _sql_constraints = [
+        ("name_uniq", "unique(name)", "A shipment can only be logged once!"),
+    ]
+
+    @api.model
+    def _get_logged_shipments(self, keys):
+        """ Returns {idempotency key: log} for the shipments that were already created. """
+        return {log.name: log for log in self.sudo().search([("name", "in", list(keys))])}
+
+    @api.model
+    def _log_shipment(self, key, picking, barcode, labels, barcodes=None):
+        """ Records a created shipment with a copy of its shipping.label records and the
+        barcodes of its colli. The log is committed with a separate cursor right away, so it
+        outlives a rollback of the current transaction: the barcodes stay known as used even
+        when their reservation in the barcode pool is rolled back. The labels are read back
+        one at a time, as they were attached. """
+        try:
+            with self.pool.cursor() as cr:
+                log = self.with_env(self.env(cr=cr)).sudo().create({
+                    "name": key,
+                    "picking_name": picking.name,
+                    "barcode": barcode,
+                    "barcode_ids": [(0, 0, {"name": colli_barcode}) for colli_barcode in barcodes or [barcode]],
+                })
+                for label_id in labels.ids:
+                    # browsed alone, so its content is not prefetched with the other labels
+                    label = labels.browse(label_id)
+                    log.env["ir.attachment"].create({
+                        "name": label.name,
+                        "datas": label.datas,
+                        "datas_fname": label.datas_fname,
+                        "res_model": self._name,
+                        "res_id": log.id,
+                    })
+        except psycopg2.IntegrityError:
+            _logger.info("PostNL shipment %s of %s was already logged", barcode, picking.name)
+
+    @api.multi
+    def _replay(self, picking):
+        """ Returns the shipping data of a logged shipment, attaching its labels to the
+        picking unless they are already there. """
+        self.ensure_one()
+        existing_labels = self.env["shipping.label"].search([
+            ("res_model", "=", "stock.picking"),
+            ("res_id", "=", picking.id),
+            ("checksum", "in", self.attachment_ids.mapped("checksum")),
+        ])
+        if existing_labels:
+            labels = existing_labels
+        else:
+            file_type = self.env.context.get("postnl_label_file_type") or "pdf"
+            labels = picking.attach_postnl_labels({
+                "name": attachment.name,
+                "file": attachment.datas,
+                "filename": attachment.datas_fname,
+                "file_type": file_type,
+            } for attachment in self.attachment_ids)
+        return {
+            "exact_price": 0,  # PostNL does not provide the cost
+            "tracking_number": self.barcode,
+            "label_attachment_ids": labels.mapped("attachment_id").ids,
+            "error": False,
+        }
+
+    @api.model
+    def _cron_cleanup(self):
+        """ Removes the logs older than `postnl_shipment_log_retention_days` days. """
+        days = int(self.env["ir.config_parameter"].sudo().get_param("postnl_shipment_log_retention_days", default=90))
+        logs = self.search([("create_date", "<", fields.Datetime.now() - timedelta(days=days))])
+        self.env["ir.attachment"].search([("res_model", "=", self._name), ("res_id", "in", logs.ids)]).unlink()
+        logs.unlink()
+
+
+class PostNLShipmentLogBarcode(models.Model):
+    _name = "postnl.shipment.log.barcode"
+    _description = "PostNL Shipment Log Barcode"
+
+    name = fields.Char(string="Barcode", required=True, index=True, readonly=True)
+    log_id = fields.Many2one("postnl.shipment.log", string="Shipment Log", required=True, ondelete="cascade")
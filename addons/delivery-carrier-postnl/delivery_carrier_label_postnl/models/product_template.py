@@ -0,0 +1,22 @@
+from odoo import api, models
+from .delivery_carrier import POSTNL_PAKKET_BANDS
+
+
+class ProductTemplate(models.Model):
+    _inherit = "product.template"
+
+    @api.multi
+    def write(self, vals):
+        """ Clears the cached PostNL package rates when their price changes. """
+        res = super().write(vals)
+        if "list_price" in vals and self._is_postnl_pakket_product():
+            self.clear_caches()
+        return res
+
+    @api.multi
+    def _is_postnl_pakket_product(self):
+        for _max_weight, xml_id in POSTNL_PAKKET_BANDS:
+            package_product = self.env.ref(xml_id, raise_if_not_found=False)
+            if package_product and package_product.product_tmpl_id in self:
+                return True
+        return False
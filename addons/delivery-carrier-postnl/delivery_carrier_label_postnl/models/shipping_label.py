@@ -0,0 +1,11 @@
+from odoo import api, models
+
+
+class ShippingLabel(models.Model):
+    _inherit = "shipping.label"
+
+    @api.model
+    def _get_file_type_selection(self):
+        file_types = super()._get_file_type_selection()
+        file_types.append(("zpl", "ZPL"))
+        return file_types
@@ -1,9 +1,34 @@
-from odoo import models, api
+import base64
+import io
+import json
+import logging
+import shutil
+import tempfile
+import zipfile
+from datetime import datetime, timedelta
+from itertools import groupby
+
+import pytz
+from PyPDF2 import PdfFileMerger
+
+from odoo import models, api, fields, _
+from odoo.exceptions import UserError
+from .postnl_api import POSTNL_STATUS_DELIVERED
+
+_logger = logging.getLogger(__name__)
 
 
 class StockPicking(models.Model):
     _inherit = "stock.picking"
 
+    postnl_status_code = fields.Char(string="PostNL Status Code", readonly=True, copy=False)
+    postnl_status = fields.Char(string="PostNL Status", readonly=True, copy=False)
+    postnl_status_date = fields.Datetime(string="PostNL Status Date", readonly=True, copy=False)
+    postnl_status_events = fields.Text(string="PostNL Status Events", readonly=True, copy=False)
+    postnl_status_checked_at = fields.Datetime(string="PostNL Status Checked On", readonly=True, copy=False)
+    postnl_barcode_id = fields.Many2one("postnl.barcode", string="PostNL Barcode", readonly=True, copy=False)
+    postnl_delivered = fields.Boolean(string="Delivered by PostNL", readonly=True, copy=False, index=True)
+
     def action_generate_carrier_label(self):
         """ Inherited from base_delivery_carrier_label module
             We have already created labels during the delivery_carrier.postnl_send_shipping call,
@@ -21,9 +46,196 @@ class StockPicking(models.Model):
         return super().generate_shipping_labels()
 
     def attach_postnl_labels(self, labels):
-        """ Sets a default package and attaches labels. """
+        """ Attaches labels, writing each one to the filestore as it comes from the
+        `labels` iterable. The labels of the multi-collo shipments are then linked to
+        their package, which gets the barcode of its collo as tracking number.
+
+        :return: the created shipping.label records
+        """
         self.ensure_one()
 
-        self._set_a_default_package()
+        shipping_labels = self.env["shipping.label"]
+        package_labels = {}
         for label in labels:
-                self.attach_shipping_label(label)
+            shipping_label = self.attach_shipping_label(label)
+            shipping_labels |= shipping_label
+            if label.get("package_id"):
+                package_labels.setdefault((label["package_id"], label.get("tracking_number")), []).append(
+                    shipping_label.id)
+        for (package_id, tracking_number), label_ids in package_labels.items():
+            shipping_labels.browse(label_ids).write({"package_id": package_id})
+            self.env["stock.quant.package"].browse(package_id).parcel_tracking = tracking_number
+        return shipping_labels
+
+    @api.multi
+    def _get_postnl_packages(self):
+        """ Returns {picking id: its destination packages}, read in one query. """
+        packages = {picking.id: self.env["stock.quant.package"] for picking in self}
+        move_lines = self.env["stock.move.line"].search_read(
+            [("picking_id", "in", self.ids), ("result_package_id", "!=", False)],
+            ["picking_id", "result_package_id"], order="result_package_id")
+        for move_line in move_lines:
+            packages[move_line["picking_id"][0]] |= self.env["stock.quant.package"].browse(
+                move_line["result_package_id"][0])
+        return packages
+
+    @api.multi
+    def action_create_postnl_ship_wave(self):
+        """ Creates a wave shipping the selected transfers and opens it. """
+        wave = self.env["postnl.ship.wave"].create({
+            "name": _("Wave of %s transfers") % len(self),
+            "domain": repr([("id", "in", self.ids)]),
+        })
+        return {
+            "type": "ir.actions.act_window",
+            "res_model": "postnl.ship.wave",
+            "res_id": wave.id,
+            "view_mode": "form",
+        }
+
+    @api.multi
+    def action_print_postnl_labels(self):
+        """ Returns the download URL of the merged PostNL labels of the pickings. The
+        document is only built when downloaded, see `_write_postnl_labels`. """
+        self._get_postnl_labels()
+        label_print = self.env["postnl.label.print"].create({"picking_ids": [(6, 0, self.ids)]})
+        return {
+            "type": "ir.actions.act_url",
+            "url": "/postnl/labels/{}".format(label_print.id),
+            "target": "self",
+        }
+
+    @api.multi
+    def _get_postnl_labels(self):
+        """ Returns the PostNL labels of the pickings and their file type, checking
+        that they can be printed together. """
+        labels = self.env["shipping.label"].search([
+            ("res_model", "=", "stock.picking"),
+            ("res_id", "in", self.filtered(lambda x: x.carrier_id.delivery_type == "postnl").ids),
+        ], order="res_id, id")
+        if not labels:
+            raise UserError(_("There are no PostNL labels for the selected transfers!"))
+        file_types = set(labels.mapped("file_type"))
+        if len(file_types) > 1:
+            raise UserError(_("PDF and ZPL labels cannot be printed together!"))
+        return labels, file_types.pop()
+
+    @api.multi
+    def _write_postnl_labels(self, merged_file):
+        """ Writes the PostNL labels of the pickings into `merged_file`, reading them from
+        the filestore one at a time. ZPL labels are concatenated into one print job. PDF
+        labels are merged into one document, or, above `postnl_label_print_chunk_size`
+        labels, into a ZIP of documents of that many labels, as the PDF merger needs the
+        label files of a document open until it is written.
+
+        :return tuple: (file name, mimetype)
+        """
+        labels, file_type = self._get_postnl_labels()
+        if file_type != "pdf":
+            for label in labels:
+                with self._open_postnl_label(label) as label_file:
+                    shutil.copyfileobj(label_file, merged_file)
+            return "postnl_labels.{}".format(file_type), "application/octet-stream"
+
+        chunk_size = int(self.env["ir.config_parameter"].sudo().get_param(
+            "postnl_label_print_chunk_size", default=500))
+        if len(labels) <= chunk_size:
+            self._merge_postnl_pdf_labels(labels, merged_file)
+            return "postnl_labels.pdf", "application/pdf"
+        with zipfile.ZipFile(merged_file, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            for index in range(0, len(labels), chunk_size):
+                with tempfile.NamedTemporaryFile(suffix=".pdf") as chunk_file:
+                    self._merge_postnl_pdf_labels(labels[index:index + chunk_size], chunk_file)
+                    chunk_file.flush()
+                    # copied into the archive from disk, by blocks
+                    zip_file.write(chunk_file.name, "postnl_labels_{}.pdf".format(index // chunk_size + 1))
+        return "postnl_labels.zip", "application/zip"
+
+    @api.model
+    def _merge_postnl_pdf_labels(self, labels, merged_file):
+        """ Merges the PDF labels into `merged_file`. The merger reads the pages of the
+        label files lazily when writing, so they are only closed afterwards. """
+        merger = PdfFileMerger()
+        label_files = []
+        try:
+            for label in labels:
+                label_file = self._open_postnl_label(label)
+                label_files.append(label_file)
+                merger.append(label_file)
+            merger.write(merged_file)
+        finally:
+            merger.close()
+            for label_file in label_files:
+                label_file.close()
+
+    @api.model
+    def _open_postnl_label(self, label):
+        """ Opens the content of a label, from the filestore when possible. """
+        attachment = label.attachment_id.sudo()
+        if attachment.store_fname:
+            return open(attachment._full_path(attachment.store_fname), "rb")
+        return io.BytesIO(base64.b64decode(attachment.db_datas or b""))
+
+    @api.model
+    def _cron_sync_postnl_tracking_status(self, auto_commit=True):
+        """ Refreshes the PostNL status of the shipped pickings which are not delivered yet
+        and were not checked in the last `postnl_tracking_poll_interval` minutes, least
+        recently checked first, up to `postnl_tracking_batch_size` pickings per run. """
+        ParamObj = self.env["ir.config_parameter"].sudo()
+        interval = int(ParamObj.get_param("postnl_tracking_poll_interval", default=60))
+        limit = int(ParamObj.get_param("postnl_tracking_batch_size", default=1000))
+        self.env.cr.execute("""
+            SELECT picking.id
+            FROM stock_picking picking
+            JOIN delivery_carrier carrier ON carrier.id = picking.carrier_id
+            WHERE carrier.delivery_type = 'postnl'
+              AND picking.state = 'done'
+              AND picking.carrier_tracking_ref IS NOT NULL
+              AND picking.postnl_delivered IS NOT TRUE
+              AND (picking.postnl_status_checked_at IS NULL OR picking.postnl_status_checked_at < %s)
+            ORDER BY picking.postnl_status_checked_at ASC NULLS FIRST, picking.id
+            LIMIT %s
+        """, (fields.Datetime.now() - timedelta(minutes=interval), limit))
+        pickings = self.browse([row[0] for row in self.env.cr.fetchall()])
+        for carrier, carrier_pickings in groupby(pickings.sorted(lambda x: x.carrier_id.id), key=lambda x: x.carrier_id):
+            self.browse([picking.id for picking in carrier_pickings])._sync_postnl_tracking_status(carrier)
+            if auto_commit:
+                self.env.cr.commit()
+
+    @api.multi
+    def action_sync_postnl_tracking_status(self):
+        pickings = self.filtered(lambda x: x.carrier_id.delivery_type == "postnl" and x.carrier_tracking_ref)
+        for carrier in pickings.mapped("carrier_id"):
+            pickings.filtered(lambda x: x.carrier_id == carrier)._sync_postnl_tracking_status(carrier)
+
+    @api.multi
+    def _sync_postnl_tracking_status(self, carrier):
+        """ Fetches the status of the pickings' shipments in one concurrent batch
+        and stores the latest status and events on the pickings. """
+        statuses = carrier._get_postnl_api().get_shipment_statuses(self.mapped("carrier_tracking_ref"))
+        now = fields.Datetime.now()
+        for picking in self:
+            status = statuses.get(picking.carrier_tracking_ref) or {}
+            if status.get("error"):
+                _logger.warning("PostNL status of %s could not be retrieved: %s", picking.name, status["error"])
+                picking.postnl_status_checked_at = now
+                continue
+            picking.write({
+                "postnl_status_code": status["code"],
+                "postnl_status": status["description"],
+                "postnl_status_date": self._parse_postnl_timestamp(status["timestamp"]),
+                "postnl_status_events": json.dumps(status["events"]),
+                "postnl_status_checked_at": now,
+                "postnl_delivered": status["code"] == POSTNL_STATUS_DELIVERED,
+            })
+
+    @api.model
+    def _parse_postnl_timestamp(self, timestamp):
+        """ Converts a PostNL timestamp (Dutch local time) into a UTC datetime. """
+        if not timestamp:
+            return False
+        try:
+            local_date = datetime.strptime(timestamp, "%d-%m-%Y %H:%M:%S")
+        except ValueError:
+            return False
+        return pytz.timezone("Europe/Amsterdam").localize(local_date).astimezone(pytz.utc).replace(tzinfo=None)
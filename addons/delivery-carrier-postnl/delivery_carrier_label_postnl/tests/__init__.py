@@ -1 +1,2 @@
 from . import test_delivery_postnl
+from . import test_postnl_benchmark
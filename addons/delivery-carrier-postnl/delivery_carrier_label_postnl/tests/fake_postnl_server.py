@@ -0,0 +1,153 @@
+""" Local stand-in for the PostNL shipment API, for load tests and benchmarks.
+
+It answers POST /v1/shipment with a barcode and a label per shipment, and can inject
+latency, 429 and 5xx responses and malformed bodies. Run it standalone with::
+
+    python fake_postnl_server.py --port 8765 --latency 0.05 --rate-429 0.01
+
+or start it from a test with `FakePostNLServer(...).start()`.
+"""
+import argparse
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+FAKE_LABEL_CONTENT = base64.b64encode(b"%PDF-1.4 fake PostNL label").decode()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakePostNLServer():
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, rate_429=0.0, rate_5xx=0.0,
+                 rate_malformed=0.0, seed=None):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.rate_malformed = rate_malformed
+        self.random = random.Random(seed)
+        self.barcodes = itertools.count(1)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.httpd = _ThreadingHTTPServer((host, port), self._get_handler_class())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _next_fault(self):
+        """ Draws the fault to inject for a request, if any. """
+        with self.lock:
+            self.request_count += 1
+            draw = self.random.random()
+        for fault, rate in (("429", self.rate_429), ("5xx", self.rate_5xx), ("malformed", self.rate_malformed)):
+            if draw < rate:
+                return fault
+            draw -= rate
+        return None
+
+    def _next_barcode(self):
+        with self.lock:
+            return "3SFAKE{:09d}".format(next(self.barcodes))
+
+    def _get_shipment_response(self, body):
+        response_shipments = []
+        for shipment in body.get("Shipments") or []:
+            response_shipments.append({
+                "Barcode": shipment.get("Barcode") or self._next_barcode(),
+                "Reference": shipment.get("Reference"),
+                "ProductCodeDelivery": shipment.get("ProductCodeDelivery"),
+                "Labels": [{"Content": FAKE_LABEL_CONTENT, "Labeltype": "Label", "OutputType": "PDF"}],
+                "Warnings": [],
+            })
+        return {"ResponseShipments": response_shipments}
+
+    def _get_handler_class(self):
+        server = self
+
+        class FakePostNLHandler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body, content_type="application/json"):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                payload = self.rfile.read(length)
+                if server.latency:
+                    time.sleep(server.latency)
+                if not self.headers.get("apikey"):
+                    return self._send(401, {"fault": {"faultstring": "Invalid ApiKey"}})
+                fault = server._next_fault()
+                if fault == "429":
+                    return self._send(429, {"fault": {"faultstring": "Rate limit quota violation"}})
+                if fault == "5xx":
+                    return self._send(503, {"fault": {"faultstring": "Service unavailable"}})
+                if fault == "malformed":
+                    return self._send(200, b'{"ResponseShipments": [{"Barcode": ')
+                try:
+                    body = json.loads(payload.decode() or "{}")
+                except ValueError:
+                    return self._send(400, {"Errors": [{"Description": "Invalid JSON"}]})
+                return self._send(200, server._get_shipment_response(body))
+
+        return FakePostNLHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of 429 responses")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="share of 503 responses")
+    parser.add_argument("--rate-malformed", type=float, default=0.0, help="share of truncated bodies")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    server = FakePostNLServer(
+        args.host, args.port, args.latency, args.rate_429, args.rate_5xx, args.rate_malformed, args.seed)
+    print("Fake PostNL shipment API listening on {}/v1/shipment".format(server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
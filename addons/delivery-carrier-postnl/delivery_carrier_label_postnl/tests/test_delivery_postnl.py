@@ -1,12 +1,22 @@
 import base64
+import io
+import json
 import requests
 import uuid
+import zipfile
 from contextlib import contextmanager
 from unittest.mock import patch
 from unittest import mock
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import DecodedStreamObject, NameObject
+from psycopg2 import IntegrityError
+from psycopg2.extensions import TransactionRollbackError
 from odoo.tests.common import SavepointCase
 from odoo.tests import tagged
+from odoo import fields
+from odoo.tools import mute_logger
 from odoo.exceptions import UserError
+from odoo.addons.delivery_carrier_label_postnl.models.postnl_api import PostNLAPI
 
 
 @tagged('post_install', '-at_install')
@@ -15,6 +25,8 @@ class TestDeliveryPostNL(SavepointCase):
     @classmethod
     def setUpClass(cls):
         super(TestDeliveryPostNL, cls).setUpClass()
+        # the separate cursors of the logs share the test transaction, and are rolled back with it
+        cls.registry.enter_test_mode(cls.cr)
 
         # set up the company and a partner/customer
         cls.company = cls.env.ref("base.main_partner")
@@ -66,6 +78,11 @@ class TestDeliveryPostNL(SavepointCase):
             }
         )
 
+    @classmethod
+    def tearDownClass(cls):
+        cls.registry.leave_test_mode()
+        super(TestDeliveryPostNL, cls).tearDownClass()
+
     def test_01_postnl_ok_flow(self):
         orderline_vals = [
             (0, 0, {
@@ -158,10 +175,603 @@ class TestDeliveryPostNL(SavepointCase):
         base_url = param_obj.get_param("postnl_tracking_base_url", default=False)
         self.assertEquals(tracking_link, "{}/{}-NL-{}".format(base_url, test_barcode, self.partner.zip), "Incorrect tracking URL.")
 
+    def test_04_postnl_concurrent_send_keeps_order(self):
+        self.env["ir.config_parameter"].sudo().set_param("postnl_shipping_api_max_workers", 4)
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        pickings = self.env["stock.picking"]
+        for _i in range(5):
+            pickings |= self._create_postnl_picking(carrier)
+
+        with self._setup_mock_ok_request(barcode=False) as mock_requests:
+            mock_requests.request.side_effect = self._mock_response_by_message_id
+            result = carrier.postnl_send_shipping(pickings)
+
+        self.assertEquals(
+            [res["tracking_number"] for res in result],
+            ["BC{}".format(picking.id) for picking in pickings],
+            "Results are not in the order of the pickings.")
+
+    def test_05_postnl_batched_send(self):
+        self.env["ir.config_parameter"].sudo().set_param("postnl_shipping_api_batch_size", 3)
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        pickings = self.env["stock.picking"]
+        for _i in range(5):
+            pickings |= self._create_postnl_picking(carrier)
+
+        with self._setup_mock_ok_request(barcode=False) as mock_requests:
+            mock_requests.request.side_effect = self._mock_response_by_reference
+            result = carrier.postnl_send_shipping(pickings)
+
+        self.assertEquals(mock_requests.request.call_count, 2, "Pickings were not sent in batches.")
+        self.assertEquals(
+            [res["tracking_number"] for res in result],
+            ["BC{}".format(picking.name) for picking in pickings],
+            "Response shipments are not mapped back to their picking.")
+
+        other_pickings = self._create_postnl_picking(carrier) | self._create_postnl_picking(carrier)
+        with self.assertRaises(UserError), self._setup_mock_ok_request(barcode=False) as mock_requests:
+            mock_requests.request.side_effect = self._mock_response_by_reference_with_error
+            carrier.postnl_send_shipping(other_pickings)
+
+    def test_06_postnl_session_is_pooled(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        with patch.dict("odoo.addons.delivery_carrier_label_postnl.models.postnl_api._sessions", clear=True):
+            session = carrier._get_postnl_api().session
+            self.assertIs(carrier._get_postnl_api().session, session, "The HTTP session is not reused.")
+            self.assertEquals(
+                session.get_adapter("https://").max_retries.read, 0, "Read timeouts must not resend a shipment.")
+            carrier.postnl_api_key = "other key"
+            self.assertIsNot(carrier._get_postnl_api().session, session, "API keys must not share a session.")
+
+    def test_07_postnl_deferred_shipping(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        carrier.postnl_deferred_shipping = True
+        picking = self._create_postnl_picking(carrier)
+
+        with self._setup_mock_invalid_apikey_request() as mock_requests:
+            picking.action_done()
+            self.assertFalse(mock_requests.request.called, "Validation should not call PostNL.")
+        job = self.env["postnl.shipment.job"].search([("picking_id", "=", picking.id)])
+        self.assertEquals(job.state, "pending", "The shipment was not queued.")
+
+        with self._setup_mock_invalid_apikey_request():
+            job._cron_process_jobs(auto_commit=False)
+        self.assertEquals(job.state, "pending", "A failed job should be retried.")
+        self.assertEquals(job.attempt_count, 1, "The failed attempt was not counted.")
+        self.assertTrue(job.last_error, "The error was not recorded.")
+        job.state = "failed"
+        self.assertFalse(
+            job._enqueue(carrier, picking), "A picking with an open job should not be queued twice.")
+        job.action_retry()
+
+        with self._setup_mock_ok_request(barcode="12345"):
+            job._cron_process_jobs(auto_commit=False)
+        self.assertEquals(job.state, "done", "The queued shipment was not sent.")
+        self.assertEquals(picking.carrier_tracking_ref, "12345", "Incorrect tracking reference.")
+
+    def test_08_postnl_cached_rate_is_invalidated(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        self.assertEquals(carrier._get_postnl_pakket_rate(1.0), 4.1, "Incorrect package rate.")
+        self.assertEquals(carrier._get_postnl_pakket_rate(15.0), 13, "Incorrect package rate.")
+
+        self.env.ref("delivery_carrier_label_postnl.product_product_delivery_postnl_pakket_2").list_price = 4.5
+        self.assertEquals(carrier._get_postnl_pakket_rate(1.0), 4.5, "The cached package rate was not cleared.")
+
+    def test_09_postnl_rate_table(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        csv_data = "\n".join([
+            "product_code,zone,max_weight,price",
+            "3085,NL,2,3.5",
+            "3085,NL,10,6",
+            "3085,,5,20",
+        ])
+        self.env["postnl.rate.import"].create({
+            "carrier_id": carrier.id,
+            "file": base64.b64encode(csv_data.encode()),
+        }).action_import()
+
+        self.assertEquals(carrier._get_postnl_price(2, "NL"), 3.5, "Incorrect rate of the weight band.")
+        self.assertEquals(carrier._get_postnl_price(2.5, "NL"), 6, "Incorrect rate of the weight band.")
+        self.assertEquals(carrier._get_postnl_price(4, "BE"), 20, "The rate of any zone was not applied.")
+        self.assertIsNone(carrier._get_postnl_price(12, "NL"), "Weights above the table should not be rated.")
+
+        carrier.postnl_rate_ids.filtered(lambda rate: rate.max_weight == 10).price = 7
+        self.assertEquals(carrier._get_postnl_price(2.5, "NL"), 7, "The cached rate table was not cleared.")
+
+        with self.assertRaises(IntegrityError), self.cr.savepoint(), mute_logger("odoo.sql_db"):
+            self.env["postnl.rate"].create({
+                "carrier_id": carrier.id, "product_code": "3085", "zone": False, "max_weight": 5, "price": 25})
+
+    def test_10_postnl_batch_rating(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        orders = self.env["sale.order"]
+        for qty in (1.0, 5.0, 15.0):
+            orders |= self.env["sale.order"].create(
+                {
+                    "partner_id": self.partner.id,
+                    "order_line": [(0, 0, {
+                        "product_id": self.product_variant.id,
+                        "product_uom_qty": qty,
+                        "price_unit": self.product_variant.lst_price
+                        })],
+                    "carrier_id": carrier.id,
+                }
+            )
+
+        result = carrier.postnl_rate_shipments(orders)
+        self.assertEquals(
+            [result[order.id]["price"] for order in orders], [4.1, 6.75, 13],
+            "Incorrect PostNL shipping prices.")
+
+    def test_11_postnl_print_merged_zpl_labels(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        carrier.postnl_printer_type = "Zebra|Generic ZPL II 200 dpi"
+        pickings = self._create_postnl_picking(carrier) | self._create_postnl_picking(carrier)
+
+        with self._setup_mock_ok_request(barcode=False) as mock_requests:
+            mock_requests.request.side_effect = self._mock_response_by_message_id
+            carrier.postnl_send_shipping(pickings)
+            self.assertEquals(
+                json.loads(mock_requests.request.call_args[1]["data"])["Message"]["Printertype"],
+                "Zebra|Generic ZPL II 200 dpi", "The label format was not requested.")
+
+        action = pickings.action_print_postnl_labels()
+        label_print = self.env["postnl.label.print"].browse(int(action["url"].split("/")[-1]))
+        self.assertEquals(label_print.picking_ids, pickings, "Incorrect transfers to print.")
+        merged_file = io.BytesIO()
+        filename, mimetype = label_print.picking_ids._write_postnl_labels(merged_file)
+        self.assertEquals(filename, "postnl_labels.zpl", "Incorrect file name.")
+        self.assertEquals(
+            merged_file.getvalue(),
+            "".join("^XA{}^XZ".format(picking.id) for picking in pickings).encode(),
+            "The ZPL labels were not merged into one print job.")
+
+    def test_23_postnl_print_merged_pdf_labels(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        carrier.postnl_printer_type = "GraphicFile|PDF"
+        pickings = self._create_postnl_picking(carrier) | self._create_postnl_picking(carrier)
+        with self._setup_mock_ok_request(barcode=False) as mock_requests:
+            mock_requests.request.side_effect = self._mock_pdf_response_by_message_id
+            carrier.postnl_send_shipping(pickings)
+        expected_contents = [self._get_pdf_label_text(picking.id) for picking in pickings]
+
+        merged_file = io.BytesIO()
+        filename, mimetype = pickings._write_postnl_labels(merged_file)
+        self.assertEquals(filename, "postnl_labels.pdf", "Incorrect file name.")
+        merged_pdf = PdfFileReader(merged_file)
+        self.assertEquals(
+            [merged_pdf.getPage(index).getContents().getData() for index in range(merged_pdf.getNumPages())],
+            expected_contents, "The PDF labels were not merged with their content.")
+
+        self.env["ir.config_parameter"].sudo().set_param("postnl_label_print_chunk_size", "1")
+        zip_file = io.BytesIO()
+        filename, mimetype = pickings._write_postnl_labels(zip_file)
+        self.assertEquals(filename, "postnl_labels.zip", "The labels were not split in chunks.")
+        with zipfile.ZipFile(zip_file) as archive:
+            contents = [
+                PdfFileReader(io.BytesIO(archive.read(name))).getPage(0).getContents().getData()
+                for name in sorted(archive.namelist())
+            ]
+        self.assertEquals(contents, expected_contents, "The PDF chunks lost their content.")
+
+    def test_12_postnl_api_calls_are_logged(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        picking = self._create_postnl_picking(carrier)
+
+        with self.assertRaises(UserError), self._setup_mock_invalid_apikey_request():
+            carrier.postnl_send_shipping(picking)
+        with self._setup_mock_ok_request(barcode="12345"):
+            carrier.postnl_send_shipping(picking)
+
+        calls = self.env["postnl.api.call"].search([("picking_names", "=", picking.name)])
+        self.assertEquals(len(calls), 2, "The API calls were not logged.")
+        self.assertEquals(sorted(calls.mapped("status_code")), [205, 401], "Incorrect HTTP status logged.")
+        metrics = [m for m in calls.get_postnl_metrics() if m["carrier_id"] == carrier.id][0]
+        self.assertTrue(metrics["error_count"] >= 1, "The failed call was not counted.")
+        self.assertTrue(metrics["p99"] >= metrics["p50"], "Incorrect percentiles.")
+
+    def test_13_postnl_prepare_shipments_in_bulk(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        partner_without_zip = self.partner.copy({"zip": False})
+        pickings = self._create_postnl_picking(carrier) | self._create_postnl_picking(carrier)
+        invalid_picking = self._create_postnl_picking(carrier, partner=partner_without_zip)
+
+        prepared_shipments, errors = carrier._get_postnl_api()._prepare_shipments(pickings | invalid_picking)
+
+        self.assertEquals(list(errors), invalid_picking.ids, "Only the address without zip is invalid.")
+        self.assertEquals(sorted(prepared_shipments), sorted(pickings.ids), "The valid pickings were not prepared.")
+        self.assertIs(
+            prepared_shipments[pickings[0].id]["customer"], prepared_shipments[pickings[1].id]["customer"],
+            "The sender block should be built once per company and carrier.")
+        self.assertEquals(
+            prepared_shipments[pickings[0].id]["shipments"][0]["Dimension"]["Weight"], "1000.0",
+            "Incorrect weight in grams.")
+
+    def test_14_postnl_partial_send(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        partner_without_zip = self.partner.copy({"zip": False})
+        picking = self._create_postnl_picking(carrier)
+        invalid_picking = self._create_postnl_picking(carrier, partner=partner_without_zip)
+
+        with self.assertRaises(UserError), self._setup_mock_ok_request(barcode="12345") as mock_requests:
+            carrier.postnl_send_shipping(picking | invalid_picking)
+        self.assertFalse(mock_requests.request.called, "Nothing should be sent when an address is invalid.")
+
+        with self._setup_mock_ok_request(barcode="12345") as mock_requests:
+            result = carrier.postnl_send_shipping(picking | invalid_picking, raise_on_error=False)
+        self.assertEquals(mock_requests.request.call_count, 1, "Only the valid picking should be sent.")
+        self.assertEquals(result[0]["tracking_number"], "12345", "The valid picking was not shipped.")
+        self.assertFalse(result[0]["error"], "The valid picking should not report an error.")
+        self.assertFalse(result[1]["tracking_number"], "The invalid picking should not be shipped.")
+        self.assertIn("zip", result[1]["error"], "The invalid address was not reported.")
+
+    def test_15_postnl_idempotent_send(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        picking = self._create_postnl_picking(carrier)
+
+        with self._setup_mock_ok_request(barcode="12345"):
+            first_result = carrier.postnl_send_shipping(picking)
+        with self._setup_mock_ok_request(barcode="67890") as mock_requests:
+            second_result = carrier.postnl_send_shipping(picking)
+
+        logs = self.env["postnl.shipment.log"].search([("picking_name", "=", picking.name)])
+        self.assertEquals(logs.mapped("barcode"), ["12345"], "The created shipment was not logged.")
+        self.assertEquals(
+            logs.attachment_ids.mapped("datas"), [base64.b64encode(b"3SDEVC6659149")],
+            "The labels were not logged.")
+        self.assertFalse(mock_requests.request.called, "An already created shipment was sent again.")
+        self.assertEquals(second_result[0]["tracking_number"], "12345", "The logged barcode was not returned.")
+        self.assertEquals(
+            second_result[0]["label_attachment_ids"], first_result[0]["label_attachment_ids"],
+            "The labels should not be attached twice.")
+
+    def test_16_postnl_tracking_status_sync(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        picking = self._create_postnl_picking(carrier)
+        with self._setup_mock_ok_request(barcode="3SABCD1234567"):
+            picking.action_done()
+
+        with self._setup_mock_ok_request(barcode=False) as mock_requests:
+            mock_requests.request.return_value.json.return_value = {
+                "CompleteStatus": {
+                    "Shipment": {
+                        "Barcode": "3SABCD1234567",
+                        "Status": {
+                            "StatusCode": "11",
+                            "StatusDescription": "Zending afgeleverd",
+                            "TimeStamp": "15-10-2026 14:30:00",
+                        },
+                        "Event": [{"Code": "J01", "Description": "Zending afgeleverd"}],
+                    }
+                }
+            }
+            self.env["stock.picking"]._cron_sync_postnl_tracking_status(auto_commit=False)
+            self.assertIn("3SABCD1234567", mock_requests.request.call_args[1]["url"], "Incorrect status URL.")
+
+        self.assertTrue(picking.postnl_delivered, "The delivery was not registered.")
+        self.assertEquals(picking.postnl_status, "Zending afgeleverd", "Incorrect PostNL status.")
+        self.assertEquals(
+            picking.postnl_status_date, fields.Datetime.to_datetime("2026-10-15 12:30:00"),
+            "The status date should be converted to UTC.")
+
+        with self._setup_mock_ok_request(barcode=False) as mock_requests:
+            self.env["stock.picking"]._cron_sync_postnl_tracking_status(auto_commit=False)
+            self.assertFalse(mock_requests.request.called, "Delivered shipments should not be polled.")
+
+    def test_17_postnl_barcode_pool(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        carrier.write({"postnl_use_barcode_pool": True, "postnl_barcode_pool_size": 3})
+        with self._setup_mock_ok_request(barcode=False) as mock_requests:
+            mock_requests.request.side_effect = self._mock_barcode_response
+            self.env["postnl.barcode"]._refill(carrier)
+        self.assertEquals(
+            self.env["postnl.barcode"].search_count([("carrier_id", "=", carrier.id), ("state", "=", "available")]), 3,
+            "The barcode pool was not filled.")
+
+        pickings = self._create_postnl_picking(carrier) | self._create_postnl_picking(carrier)
+        with self._setup_mock_ok_request(barcode=False) as mock_requests:
+            mock_requests.request.side_effect = self._mock_response_by_reference
+            carrier.postnl_send_shipping(pickings)
+            sent_barcodes = [
+                shipment["Barcode"]
+                for call in mock_requests.request.call_args_list
+                for shipment in json.loads(call[1]["data"])["Shipments"]
+            ]
+        self.assertEquals(
+            sent_barcodes, pickings.mapped("postnl_barcode_id.name"), "The reserved barcodes were not sent.")
+        self.assertEquals(len(set(sent_barcodes)), 2, "A barcode was handed out twice.")
+
+        # the reservations are rolled back after the shipments were created
+        pickings.mapped("postnl_barcode_id").write({"state": "available", "picking_id": False})
+        pickings.write({"postnl_barcode_id": False})
+        other_picking = self._create_postnl_picking(carrier)
+        with self._setup_mock_ok_request(barcode=False) as mock_requests:
+            mock_requests.request.side_effect = self._mock_barcode_response
+            self.env["postnl.barcode"]._reserve(carrier, other_picking)
+        self.assertNotIn(
+            other_picking.postnl_barcode_id.name, sent_barcodes, "The barcode of a created shipment was reused.")
+
+    def test_18_postnl_rate_limit(self):
+        ParamObj = self.env["ir.config_parameter"].sudo()
+        ParamObj.set_param("postnl_api_rate_limit", "0")
+        self.assertIsNone(self.env["postnl.rate.limit"]._get_throttle("apikey"), "Calls are throttled without limit.")
+
+        ParamObj.set_param("postnl_api_rate_limit", "2")
+        ParamObj.set_param("postnl_api_rate_limit_burst", "1")
+        throttle = self.env["postnl.rate.limit"]._get_throttle(str(uuid.uuid4()))
+        with patch("odoo.addons.delivery_carrier_label_postnl.models.postnl_rate_limit.time") as mock_time:
+            throttle()
+            self.assertFalse(mock_time.sleep.called, "The first call within the burst was held.")
+            throttle()
+            throttle()
+        waits = [call[0][0] for call in mock_time.sleep.call_args_list]
+        self.assertEquals(len(waits), 2, "The calls over the budget were not queued.")
+        self.assertGreater(waits[1], waits[0], "The queued calls do not wait their turn.")
+        self.assertLessEqual(waits[1], 1.0, "The queued calls wait longer than the budget requires.")
+
+        # the bucket updated by a concurrent worker fails the REPEATABLE READ upsert
+        cursor = self.registry.cursor
+        conflicts = [TransactionRollbackError("could not serialize access due to concurrent update")]
+
+        def conflicting_cursor():
+            if conflicts:
+                raise conflicts.pop()
+            return cursor()
+
+        with patch.object(self.registry, "cursor", side_effect=conflicting_cursor) as mock_cursor, \
+                patch("odoo.addons.delivery_carrier_label_postnl.models.postnl_rate_limit.time"):
+            throttle()
+        self.assertEquals(mock_cursor.call_count, 2, "The token is not taken again after a concurrent update.")
+
+        # a failing throttle is reported as the outcome of the call
+        client = PostNLAPI(
+            "https://api-sandbox.postnl.nl/v1/shipment", "apikey", False,
+            throttle=mock.Mock(side_effect=TransactionRollbackError()))
+        with self._setup_mock_ok_request(barcode=False) as mock_requests:
+            response, duration, exception = client._request("POST", client.shipping_api_url, data="{}")
+        self.assertIsNone(response, "A call was made without a token.")
+        self.assertIsInstance(exception, TransactionRollbackError, "The throttle error is not reported.")
+        self.assertFalse(mock_requests.request.called, "A call was made without a token.")
+
+    def test_19_postnl_client_is_cached(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        # the clients cached from the values of this test must not outlive its rollback
+        self.addCleanup(carrier.clear_caches)
+        client = carrier._get_postnl_api()
+        self.assertIs(carrier._get_postnl_api(), client, "The PostNL client is not reused.")
+
+        carrier.postnl_confirm_shipment = not carrier.postnl_confirm_shipment
+        self.assertIsNot(carrier._get_postnl_api(), client, "The PostNL client ignores the carrier changes.")
+
+        client = carrier._get_postnl_api()
+        self.env["ir.config_parameter"].sudo().set_param("postnl_shipping_api_max_workers", "4")
+        self.assertEquals(carrier._get_postnl_api().max_workers, 4, "The PostNL client ignores the parameter changes.")
+
+        carrier.prod_environment = not carrier.prod_environment
+        self.assertNotEquals(
+            carrier._get_postnl_api().shipping_api_url, client.shipping_api_url,
+            "The PostNL client ignores the environment.")
+
+    def test_20_postnl_multi_collo(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        picking = self._create_postnl_picking(carrier)
+        move = picking.move_lines
+        picking.move_line_ids.unlink()
+        packages = self.env["stock.quant.package"]
+        for weight in (3.0, 4.0):
+            package = self.env["stock.quant.package"].create({"shipping_weight": weight})
+            self.env["stock.move.line"].create({
+                "move_id": move.id,
+                "picking_id": picking.id,
+                "product_id": move.product_id.id,
+                "product_uom_id": move.product_uom.id,
+                "location_id": move.location_id.id,
+                "location_dest_id": move.location_dest_id.id,
+                "qty_done": 0.5,
+                "result_package_id": package.id,
+            })
+            packages |= package
+
+        with self._setup_mock_ok_request(barcode=False) as mock_requests:
+            mock_requests.request.side_effect = self._mock_multi_collo_response
+            result = carrier.postnl_send_shipping(picking)
+            shipments = [
+                json.loads(call[1]["data"])["Shipments"]
+                for call in mock_requests.request.call_args_list
+                if call[1]["method"] == "POST"
+            ]
+
+        self.assertEquals(len(shipments), 1, "The packages were not sent in one request.")
+        barcodes = [shipment["Barcode"] for shipment in shipments[0]]
+        self.assertEquals(len(set(barcodes)), 2, "Each package needs its own barcode.")
+        self.assertEquals(
+            [shipment["Dimension"]["Weight"] for shipment in shipments[0]], ["3000.0", "4000.0"],
+            "The packages were not weighed separately.")
+        self.assertEquals(
+            [shipment["Groups"][0]["MainBarcode"] for shipment in shipments[0]], [barcodes[0]] * 2,
+            "The packages were not grouped under the main barcode.")
+        self.assertEquals(result[0]["tracking_number"], barcodes[0], "Incorrect main barcode.")
+        self.assertEquals(packages.mapped("parcel_tracking"), barcodes, "The package barcodes were not stored.")
+        labels = self.env["shipping.label"].search([
+            ("res_model", "=", "stock.picking"), ("res_id", "=", picking.id)])
+        self.assertEquals(labels.mapped("package_id"), packages, "The labels were not attached to the packages.")
+
+        # a retry after a rollback gets other barcodes, yet must match the logged shipment
+        api = carrier._get_postnl_api()
+        prepared_shipments, errors = api._prepare_shipments(picking)
+        key = api._get_idempotency_key(picking.id, prepared_shipments[picking.id])
+        for shipment in prepared_shipments[picking.id]["shipments"]:
+            shipment["Barcode"] = shipment["Groups"][0]["MainBarcode"] = "3SOTHER"
+        self.assertEquals(
+            api._get_idempotency_key(picking.id, prepared_shipments[picking.id]), key,
+            "The barcodes must not change the idempotency key.")
+
+    def test_21_postnl_ship_wave_resumes(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        carrier.postnl_deferred_shipping = True
+        pickings = self._create_postnl_picking(carrier) | self._create_postnl_picking(carrier) \
+            | self._create_postnl_picking(carrier)
+        unvalidated_picking = self._create_postnl_picking(carrier)
+        with self._setup_mock_invalid_apikey_request():
+            pickings.action_done()
+        wave = self.env["postnl.ship.wave"].create({
+            "domain": repr([("id", "in", (pickings | unvalidated_picking).ids)]),
+            "chunk_size": 2,
+        })
+        wave.action_start()
+        self.assertEquals(wave.picking_count, 3, "Only the validated transfers should be shipped.")
+
+        with self._setup_mock_ok_request(barcode=False) as mock_requests:
+            mock_requests.request.side_effect = self._mock_response_by_reference
+            # interrupted after the first chunk
+            self.assertTrue(wave._run_chunk())
+            self.assertEquals(wave.last_picking_id, pickings[1].id, "The checkpoint was not moved.")
+            wave._run(auto_commit=False)
+            sent_references = [
+                shipment["Reference"]
+                for call in mock_requests.request.call_args_list
+                for shipment in json.loads(call[1]["data"])["Shipments"]
+            ]
+
+        self.assertEquals(sent_references, pickings.mapped("name"), "Each transfer must be sent once.")
+        self.assertEquals(wave.state, "done", "The wave was not finished.")
+        self.assertEquals((wave.done_count, wave.failed_count), (3, 0), "Incorrect wave progress.")
+        self.assertEquals(
+            pickings.mapped("carrier_tracking_ref"), ["BC{}".format(name) for name in pickings.mapped("name")],
+            "The tracking numbers were not stored.")
+
+    def test_22_postnl_labels_are_attached(self):
+        carrier = self.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        picking = self._create_postnl_picking(carrier)
+
+        with self._setup_mock_ok_request(barcode="12345") as mock_requests:
+            result = carrier.postnl_send_shipping(picking)
+            response_labels = mock_requests.request.return_value.json.return_value["ResponseShipments"][0]["Labels"]
+
+        labels = self.env["shipping.label"].search([("res_model", "=", "stock.picking"), ("res_id", "=", picking.id)])
+        self.assertEquals(len(labels), 1, "The label was not attached.")
+        self.assertEquals(
+            result[0]["label_attachment_ids"], labels.mapped("attachment_id").ids,
+            "The result does not point at the attached labels.")
+        self.assertEquals(labels.datas, base64.b64encode(b"3SDEVC6659149"), "Incorrect label content.")
+        self.assertNotIn("Content", response_labels[0], "The label content was kept in the response.")
+
+    def _create_postnl_picking(self, carrier, partner=None):
+        sale_order = self.env["sale.order"].create(
+            {
+                "partner_id": (partner or self.partner).id,
+                "order_line": [(0, 0, {
+                    "product_id": self.product_variant.id,
+                    "product_uom_qty": 1.0,
+                    "price_unit": self.product_variant.lst_price
+                    })],
+                "carrier_id": carrier.id,
+            }
+        )
+        sale_order.action_confirm()
+        picking = sale_order.picking_ids[0]
+        picking.move_lines[0].quantity_done = 1.0
+        return picking
+
+    @staticmethod
+    def _mock_response_by_message_id(method, url, headers, data, timeout):
+        data = json.loads(data)
+        response_mock = mock.Mock()
+        response_mock.status_code = 200
+        response_mock.json.return_value = {
+            "ResponseShipments": [
+                {
+                    "Barcode": "BC{}".format(data["Message"]["MessageID"]),
+                    "Labels": [
+                        {
+                            "Content": base64.b64encode("^XA{}^XZ".format(data["Message"]["MessageID"]).encode()),
+                            "Labeltype": "Label",
+                        }
+                    ],
+                }
+            ]
+        }
+        return response_mock
+
+    @staticmethod
+    def _get_pdf_label_text(picking_id):
+        return "BT /F1 12 Tf 10 10 Td (Label {}) Tj ET".format(picking_id).encode()
+
+    @classmethod
+    def _get_pdf_label(cls, picking_id):
+        writer = PdfFileWriter()
+        page = writer.addBlankPage(width=100, height=100)
+        content = DecodedStreamObject()
+        content.setData(cls._get_pdf_label_text(picking_id))
+        page[NameObject("/Contents")] = writer._addObject(content)
+        pdf_file = io.BytesIO()
+        writer.write(pdf_file)
+        return pdf_file.getvalue()
+
+    @classmethod
+    def _mock_pdf_response_by_message_id(cls, method, url, headers, data, timeout):
+        response_mock = cls._mock_response_by_message_id(method, url, headers, data, timeout)
+        picking_id = int(json.loads(data)["Message"]["MessageID"])
+        label = response_mock.json.return_value["ResponseShipments"][0]["Labels"][0]
+        label["Content"] = base64.b64encode(cls._get_pdf_label(picking_id))
+        return response_mock
+
+    @staticmethod
+    def _mock_response_by_reference(method, url, headers, data, timeout):
+        data = json.loads(data)
+        response_mock = mock.Mock()
+        response_mock.status_code = 200
+        response_mock.json.return_value = {
+            "ResponseShipments": [
+                {
+                    "Barcode": "BC{}".format(shipment["Reference"]),
+                    "Labels": [],
+                    "Reference": shipment["Reference"],
+                }
+                for shipment in reversed(data["Shipments"])
+            ]
+        }
+        return response_mock
+
+    @classmethod
+    def _mock_response_by_reference_with_error(cls, method, url, headers, data, timeout):
+        response_mock = cls._mock_response_by_reference(method, url, headers, data, timeout)
+        response_shipments = response_mock.json.return_value["ResponseShipments"]
+        response_shipments[0]["Errors"] = [{"Code": "13", "Description": "Invalid zipcode"}]
+        return response_mock
+
+    @classmethod
+    def _mock_multi_collo_response(cls, method, url, headers, data, timeout):
+        if method == "GET":
+            return cls._mock_barcode_response(method, url, headers, data, timeout)
+        data = json.loads(data)
+        response_mock = mock.Mock()
+        response_mock.status_code = 200
+        response_mock.json.return_value = {
+            "ResponseShipments": [
+                {
+                    "Barcode": shipment["Barcode"],
+                    "Labels": [{"Content": base64.b64encode(shipment["Barcode"].encode()), "Labeltype": "Label"}],
+                    "Reference": shipment["Reference"],
+                }
+                for shipment in reversed(data["Shipments"])
+            ]
+        }
+        return response_mock
+
+    @staticmethod
+    def _mock_barcode_response(method, url, headers, data, timeout):
+        response_mock = mock.Mock()
+        response_mock.status_code = 200
+        response_mock.json.return_value = {"Barcode": "3SDEVC{}".format(uuid.uuid4().int % 10 ** 9)}
+        return response_mock
+
     @staticmethod
     @contextmanager
     def _setup_mock_ok_request(barcode):
-        with patch("odoo.addons.delivery_carrier_label_postnl.models.postnl_api.requests") as mock_requests:
+        with patch("odoo.addons.delivery_carrier_label_postnl.models.postnl_api.requests") as mock_requests, \
+                patch.dict("odoo.addons.delivery_carrier_label_postnl.models.postnl_api._sessions", clear=True):
+            mock_requests.Session.return_value.request = mock_requests.request
             response_mock = mock.Mock()
             type(response_mock).status_code = mock.PropertyMock(return_value=205)
             response_mock.json.return_value =  {
@@ -183,7 +793,9 @@ class TestDeliveryPostNL(SavepointCase):
     @staticmethod
     @contextmanager
     def _setup_mock_invalid_apikey_request():
-        with patch("odoo.addons.delivery_carrier_label_postnl.models.postnl_api.requests") as mock_requests:
+        with patch("odoo.addons.delivery_carrier_label_postnl.models.postnl_api.requests") as mock_requests, \
+                patch.dict("odoo.addons.delivery_carrier_label_postnl.models.postnl_api._sessions", clear=True):
+            mock_requests.Session.return_value.request = mock_requests.request
             response_mock = mock.Mock()
             type(response_mock).status_code = mock.PropertyMock(return_value=401)
             response_mock.json.return_value =  {
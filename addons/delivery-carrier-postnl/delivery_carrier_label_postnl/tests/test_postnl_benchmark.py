@@ -0,0 +1,140 @@
+import logging
+import os
+import time
+import tracemalloc
+from unittest.mock import patch
+
+from odoo.tests.common import SavepointCase
+from odoo.tests import tagged
+
+from .fake_postnl_server import FakePostNLServer
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged('post_install', '-at_install', '-standard', 'postnl_benchmark')
+class TestPostNLBenchmark(SavepointCase):
+    """ Load benchmark of the shipment of validated pickings against the local fake PostNL
+    server. The pickings are validated with deferred shipping, and the timed run is the
+    processing of their shipment jobs, which sends them with `postnl_send_shipping`.
+    Not part of the standard test run, start it with ``--test-tags postnl_benchmark``.
+
+    The sizes and the API tuning are read from the environment:
+    POSTNL_BENCHMARK_SIZES (default "10,100,1000"), POSTNL_BENCHMARK_LATENCY (seconds,
+    default 0.05), POSTNL_BENCHMARK_MAX_WORKERS (default 8), POSTNL_BENCHMARK_BATCH_SIZE
+    (default 1).
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestPostNLBenchmark, cls).setUpClass()
+        # the shipment and call logs share the test transaction instead of committing on their
+        # own cursors: the run leaves nothing behind and their queries are counted
+        cls.registry.enter_test_mode(cls.cr)
+        cls.sizes = [int(size) for size in os.environ.get("POSTNL_BENCHMARK_SIZES", "10,100,1000").split(",")]
+        cls.latency = float(os.environ.get("POSTNL_BENCHMARK_LATENCY", 0.05))
+
+        cls.carrier = cls.env.ref("delivery_carrier_label_postnl.delivery_carrier_postnl_pakket")
+        cls.carrier.write({"prod_environment": False, "postnl_deferred_shipping": True})
+        param_obj = cls.env["ir.config_parameter"].sudo()
+        param_obj.set_param("postnl_shipping_api_max_workers", os.environ.get("POSTNL_BENCHMARK_MAX_WORKERS", 8))
+        param_obj.set_param("postnl_shipping_api_batch_size", os.environ.get("POSTNL_BENCHMARK_BATCH_SIZE", 1))
+        param_obj.set_param("postnl_shipping_api_backoff_factor", 0.01)
+        # each run ships all its pickings in one job batch
+        param_obj.set_param("postnl_shipment_job_batch_size", max(cls.sizes))
+
+        cls.env.ref("base.main_company").partner_id.write({
+            "street": "Vondelstraat 87",
+            "city": "Amsterdam",
+            "zip": "1054 GT",
+            "country_id": cls.env.ref("base.nl").id,
+        })
+        cls.partner = cls.env["res.partner"].create({
+            "name": "NL Partner",
+            "street": "Spaarbankstraat 5",
+            "city": "Rotterdam",
+            "zip": "3011 HX",
+            "country_id": cls.env.ref("base.nl").id,
+        })
+        cls.product = cls.env["product.product"].create({"name": "Benchmark product", "type": "consu", "weight": 1})
+        cls.picking_type = cls.env.ref("stock.picking_type_out")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.registry.leave_test_mode()
+        super(TestPostNLBenchmark, cls).tearDownClass()
+
+    def _create_pickings(self, count):
+        """ Creates and validates `count` pickings of one unit, queuing their shipment. """
+        pickings = self.env["stock.picking"].create([{
+            "partner_id": self.partner.id,
+            "picking_type_id": self.picking_type.id,
+            "location_id": self.picking_type.default_location_src_id.id,
+            "location_dest_id": self.env.ref("stock.stock_location_customers").id,
+            "carrier_id": self.carrier.id,
+            "move_lines": [(0, 0, {
+                "name": self.product.name,
+                "product_id": self.product.id,
+                "product_uom": self.product.uom_id.id,
+                "product_uom_qty": 1.0,
+            })],
+        } for _i in range(count)])
+        pickings.action_confirm()
+        pickings.action_assign()
+        for move in pickings.mapped("move_lines"):
+            move.quantity_done = move.product_uom_qty
+        pickings.action_done()
+        return pickings
+
+    def _run_benchmark(self, server, pickings):
+        """ Processes the shipment jobs of the pickings and logs the figures of the run.
+
+        :return: the jobs of the pickings
+        """
+        self.env["ir.config_parameter"].sudo().set_param(
+            "postnl_shipping_api_test_url", "{}/v1/shipment".format(server.url))
+        jobs = self.env["postnl.shipment.job"].search([("picking_id", "in", pickings.ids)])
+        self.assertEquals(len(jobs), len(pickings), "The validated pickings were not queued.")
+        request_count = server.request_count
+        query_count = self.cr.sql_log_count
+        tracemalloc.start()
+        start = time.perf_counter()
+        jobs._cron_process_jobs(auto_commit=False)
+        wall_time = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        _logger.info(
+            "PostNL benchmark: %s pickings (%s shipped) in %.2fs, %.1f pickings/s, %s requests (%.1f/s), "
+            "%s SQL queries, %.1f MiB peak memory",
+            len(pickings), len(pickings.filtered("carrier_tracking_ref")), wall_time, len(pickings) / wall_time,
+            server.request_count - request_count, (server.request_count - request_count) / wall_time,
+            self.cr.sql_log_count - query_count, peak_memory / 1024.0 / 1024.0)
+        return jobs
+
+    def test_01_benchmark_send_shipping(self):
+        with FakePostNLServer(latency=self.latency, seed=42) as server:
+            for size in self.sizes:
+                pickings = self._create_pickings(size)
+                self._run_benchmark(server, pickings)
+                self.assertTrue(all(pickings.mapped("carrier_tracking_ref")), "Some pickings were not shipped.")
+
+    def test_02_benchmark_send_shipping_with_faults(self):
+        """ 429 and 5xx responses are absorbed by the retries of the session. """
+        with FakePostNLServer(latency=self.latency, rate_429=0.05, rate_5xx=0.02, seed=42) as server, \
+                patch.dict("odoo.addons.delivery_carrier_label_postnl.models.postnl_api._sessions", clear=True):
+            pickings = self._create_pickings(self.sizes[0])
+            self._run_benchmark(server, pickings)
+        self.assertTrue(all(pickings.mapped("carrier_tracking_ref")), "Some pickings were not shipped.")
+
+    def test_03_benchmark_send_shipping_with_malformed_responses(self):
+        """ Truncated bodies fail their own shipments only, which stay queued with their error. """
+        with FakePostNLServer(latency=self.latency, rate_malformed=0.1, seed=42) as server:
+            pickings = self._create_pickings(self.sizes[0])
+            jobs = self._run_benchmark(server, pickings)
+        failed_jobs = jobs.filtered(lambda job: job.state != "done")
+        self.assertTrue(failed_jobs, "No malformed response was injected.")
+        self.assertTrue(all(failed_jobs.mapped("last_error")), "The malformed responses were not reported.")
+        self.assertEquals(
+            pickings.filtered(lambda picking: not picking.carrier_tracking_ref), failed_jobs.mapped("picking_id"),
+            "The other pickings of the run were not shipped.")
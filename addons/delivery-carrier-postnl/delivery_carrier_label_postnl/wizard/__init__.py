@@ -0,0 +1,2 @@
+from . import postnl_rate_import
+from . import postnl_label_print
@@ -0,0 +1,8 @@
+from odoo import fields, models
+
+
+class PostNLLabelPrint(models.TransientModel):
+    _name = "postnl.label.print"
+    _description = "Print PostNL Labels"
+
+    picking_ids = fields.Many2many("stock.picking", string="Transfers")
@@ -0,0 +1,46 @@
+import base64
+import csv
+import io
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+POSTNL_RATE_CSV_COLUMNS = ["product_code", "zone", "max_weight", "price"]
+
+
+class PostNLRateImport(models.TransientModel):
+    _name = "postnl.rate.import"
+    _description = "Import PostNL Rates"
+
+    carrier_id = fields.Many2one("delivery.carrier", string="Carrier", required=True)
+    file = fields.Binary(string="CSV File", required=True)
+    replace = fields.Boolean(string="Replace Existing Rates", default=True)
+
+    @api.multi
+    def action_import(self):
+        """ Creates the rates of a CSV file with the columns
+        product_code, zone, max_weight (kg) and price (EUR), in one batch. """
+        self.ensure_one()
+        content = base64.b64decode(self.file).decode("utf-8-sig")
+        reader = csv.DictReader(io.StringIO(content))
+        missing_columns = set(POSTNL_RATE_CSV_COLUMNS) - set(reader.fieldnames or [])
+        if missing_columns:
+            raise UserError(_("Missing columns in the CSV file: %s") % ", ".join(sorted(missing_columns)))
+
+        vals_list = []
+        for line_number, row in enumerate(reader, start=2):
+            try:
+                vals_list.append({
+                    "carrier_id": self.carrier_id.id,
+                    "product_code": row["product_code"].strip(),
+                    "zone": row["zone"].strip().upper() or False,
+                    "max_weight": float(row["max_weight"]),
+                    "price": float(row["price"]),
+                })
+            except ValueError as e:
+                raise UserError(_("Invalid value on line %s of the CSV file: %s") % (line_number, e))
+
+        if self.replace:
+            self.carrier_id.postnl_rate_ids.unlink()
+        self.env["postnl.rate"].create(vals_list)
+        return {"type": "ir.actions.act_window_close"}